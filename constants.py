@@ -9,7 +9,9 @@ BUFFER_SIZE = 1500  # bytes
 ENCODING = "utf-8"
 
 # NMS protocols versions
-NET_TASK_VERSION   = 1
+# NetTask version 1 uses a 16-bit checksum, version 2 uses CRC32,
+# versions 3 and 4 add cumulative and selective ACKs to versions 1 and 2
+NET_TASK_VERSION   = 3
 ALERT_FLOW_VERSION = 1
 
 # SO_NO_CHECK for disabling UDP checksum
@@ -19,14 +21,73 @@ SO_NO_CHECK = 11
 # as the space available in the server/agent buffer
 INITIAL_WINDOW_SIZE = 32  # packets
 
-# Time to sleep before retransmitting packets
-RETRANSMIT_SLEEP_TIME = 5  # seconds
+# Window size of the server for each agent, as the space of the agent in the
+# server buffer, capped by the space left in the buffer shared by all the agents
+AGENT_WINDOW_SIZE  = 32   # packets
+SERVER_WINDOW_SIZE = 256  # packets
 
-# Time to sleep before probing the window size
+# Number of threads handling the datagrams received, and the size of the queues of
+# datagrams waiting for them, the datagrams received with the queue full are dropped.
+# The datagrams of a peer are handled by a single thread, so the agent, with the
+# server as its single peer, needs no more than one
+UDP_WORKERS       = 4
+AGENT_UDP_WORKERS = 1
+UDP_QUEUE_SIZE    = 256  # datagrams
+
+# Memory budgets of the server for the fragments of the messages being reassembled,
+# of all the agents and of each agent, the fragments over budget are discarded
+REASSEMBLY_BUDGET       = 4 * 1024 * 1024  # bytes
+AGENT_REASSEMBLY_BUDGET = 512 * 1024       # bytes
+
+# Partial messages of an agent the server reassembles at a time, the fragments
+# of the messages over them are discarded
+MAX_PARTIAL_MESSAGES = 16  # messages
+
+# Time a partial message is kept without receiving any fragment, before being evicted
+REASSEMBLY_TTL = 120  # seconds
+
+# Number of sequence numbers, after the last packet received in order,
+# tracked to discard duplicated packets (less than half the 16-bit space)
+DUPLICATE_WINDOW_SIZE = 1024  # packets
+
+# Retransmission timeout (RTO) of a peer before any round-trip time sample,
+# and its bounds, the RTO is estimated from the acknowledgments (RFC 6298)
+INITIAL_RTO = 1    # seconds
+MIN_RTO     = 0.2  # seconds
+MAX_RTO     = 60   # seconds
+
+# Congestion window of the server for each agent, in packets in flight, it starts
+# small and grows with the packets acknowledged, and shrinks on losses
+INITIAL_CONGESTION_WINDOW = 4    # packets
+MIN_CONGESTION_WINDOW     = 1    # packets
+MAX_CONGESTION_WINDOW     = 256  # packets
+
+# Packets sent in a burst to an agent before the pacing applies, and the minimum
+# round-trip time the pacing rate is calculated with (so it isn't unbounded)
+PACING_BURST   = 4      # packets
+MIN_PACING_RTT = 0.001  # seconds
+
+# Rate of the packets broadcasted to all the agents (e.g. end of connection),
+# after a burst, so a broadcast to many agents doesn't flood the uplink
+BROADCAST_RATE  = 1000  # packets per second
+BROADCAST_BURST = 64    # packets
+
+# Forward error correction (FEC) of the fragmented messages, a parity fragment is
+# sent per group of FEC_GROUP_SIZE fragments (0 disables it). The group size is
+# proposed by the agent on the first connection, within the bounds below
+FEC_GROUP_SIZE     = 0   # fragments
+MIN_FEC_GROUP_SIZE = 2   # fragments
+MAX_FEC_GROUP_SIZE = 32  # fragments
+
+# Time between window probes, while the window size of a peer is 0
 WINDOW_PROBE_SLEEP_TIME = 5  # seconds
 
+# Time an ACK can be delayed, to coalesce the ACKs of the packets received
+# meanwhile or to piggyback it on a data packet sent to the same peer
+DELAYED_ACK_TIMEOUT = 0.005  # seconds
+
 # Timout for end of connection acknowledgments
-EOC_ACK_TIMEOUT = RETRANSMIT_SLEEP_TIME * 3  # seconds
+EOC_ACK_TIMEOUT = 15  # seconds
 
 # Decimal precision for floating point numbers
 DECIMAL_PRECISION = 4
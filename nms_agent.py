@@ -6,8 +6,7 @@ import sys
 import argparse
 import time
 
-
-from constants import EOC_ACK_TIMEOUT
+import constants as C
 
 from nms_agent import (
     ClientTCP,
@@ -26,6 +25,14 @@ def main():
     arg_parser.add_argument("-v", "--verbose",
                             help="Enable verbose output",
                             action="store_true")
+    arg_parser.add_argument("-w", "--udp-workers",
+                            help="Number of threads handling the UDP packets received",
+                            type=int,
+                            default=C.AGENT_UDP_WORKERS)
+    arg_parser.add_argument("-f", "--fec",
+                            help="Fragments per parity packet (FEC) of the messages, 0 to disable",
+                            type=int,
+                            default=C.FEC_GROUP_SIZE)
     args = arg_parser.parse_args()
 
     server_ip = args.server
@@ -35,7 +42,8 @@ def main():
     client_task = ClientTask(verbose=args.verbose)
 
     tcp_client = ClientTCP(agent_id, server_ip)
-    udp_client = ClientUDP(agent_id, server_ip, pool, client_task, verbose=args.verbose)
+    udp_client = ClientUDP(agent_id, server_ip, pool, client_task, verbose=args.verbose,
+                           workers=args.udp_workers, fec_group_size=args.fec)
 
     client_task.set_client_tcp(tcp_client)
     client_task.set_client_udp(udp_client)
@@ -65,13 +73,11 @@ def main():
         # or after some seconds, if the server doesn't respond, shutdown the agent
         udp_client.send_end_of_connection()
         start_time = time.time()
-        while (pool.get_nr_packets_to_ack() > 0 and
-               time.time() - start_time < EOC_ACK_TIMEOUT):
+        while not pool.wait_packets_to_ack(timeout=1):
             if args.verbose:
                 print(f"Nr of packs to be acknowledged: {pool.get_nr_packets_to_ack()}")
                 # print(f"Packet(s) to be acknowledged: {pool.packets_to_ack}")
                 print(f"Time elapsed: {time.time() - start_time}")
-            time.sleep(1)
 
         # Shutdown the task executer
         print("Shutting down the task executer...")
@@ -1,23 +1,44 @@
 import threading
+import time
+
+from collections import deque
+
+import constants as C
 
 from constants import INITIAL_WINDOW_SIZE
+from protocol.fec import negotiate_group_size
+from protocol.net_task import MAX_NACK_SEQ_NUMBERS, SACK_VERSIONS
+from protocol.reassembly import ReassemblyBuffer
+from protocol.rtt import RTTEstimator
+from protocol.sack import ReceiveState, SEQ_MODULO, pop_acknowledged
 
 
 class Pool:
     # Current sequence number
-    # List of packets sent yet to be
+    # List of packets sent yet to be acknowledged (by sequence number)
+    # Queue of packets to be sent, as the server window size allows
     # List of packets received yet to be reordered and defragmented
-    # List of sequence numbers of packets received (for descarting duplicates)
+    # Receive state of the server packets, the window of sequence numbers
+    # received (for descarting duplicates and for the cumulative and selective ACKs)
     # Agent buffer size (window size)
     # Server buffer size (window size)
+    # Server round-trip time estimator
+    # Fragments per parity group (FEC) of the messages exchanged with the server
     def __init__(self):
         self.seq_number = 1
-        self.packets_to_ack = []
-        self.packets_to_reorder = []
-        self.packets_received = []
+        self.packets_to_ack = dict()
+        self.packets_to_send = deque()
+        self.packets_to_reorder = ReassemblyBuffer()
+        self.receive_state = ReceiveState(1)
         self.agent_window_size = INITIAL_WINDOW_SIZE
         self.server_window_size = INITIAL_WINDOW_SIZE
+        self.rtt_estimator = RTTEstimator()
+        self.fec_group_size = 0
         self.lock = threading.Lock()
+        # Notified when all the packets sent are acknowledged
+        self.packets_acked = threading.Condition(self.lock)
+        # Notified when the server window size opens (greater than 0)
+        self.server_window_open = threading.Condition(self.lock)
 
     ###
     # Sequence number
@@ -31,10 +52,35 @@ class Pool:
         with self.lock:
             self.seq_number = seq_number
 
-    def inc_seq_number(self):
+    ###
+    # Packets to be sent
+    ###
+
+    # Queue packets to be sent once they fit in the server window size
+    def queue_packets_to_send(self, packets):
         with self.lock:
-            self.seq_number += 1
-            return self.seq_number
+            self.packets_to_send.extend(packets)
+
+    # Take the packets queued that fit in the server window size, as the packets in
+    # flight (sent and not acknowledged) are bounded by the window size. The packets
+    # taken are added to the packets to be acknowledged, to be sent right away.
+    # A packet is kept in flight while the window is closed, as the window can be
+    # taken by the fragments of a message that only completes with the next ones
+    def take_packets_to_send(self):
+        with self.lock:
+            packets = []
+            while (self.packets_to_send
+                   and len(self.packets_to_ack) < max(self.server_window_size, 1)):
+                packet = self.packets_to_send.popleft()
+                self.packets_to_ack[packet.seq_number] = packet
+                packets.append(packet)
+            return packets
+
+    # Check if a packet would be sent right away, not queued behind other packets
+    def can_send_packets(self):
+        with self.lock:
+            return (not self.packets_to_send
+                    and len(self.packets_to_ack) < self.server_window_size)
 
     ###
     # Packets sent to be acknowledged
@@ -42,124 +88,157 @@ class Pool:
 
     def add_packet_to_ack(self, packet):
         with self.lock:
-            copy_packet = packet.copy()
-            self.packets_to_ack.append(copy_packet)
+            self.packets_to_ack[packet.seq_number] = packet
+
+    # Set the retransmission timer of a packet, scheduled by the callback with the
+    # timeout, unless it was acknowledged, return False if it was. The timer is set
+    # with the lock held, so an ACK removing the packet either cancels the timer
+    # or prevents it from being set, even if the expired timer is running
+    def set_retransmit_timer(self, packet, rto, schedule):
+        with self.lock:
+            if self.packets_to_ack.get(packet.seq_number) is not packet:
+                return False
+            packet.set_timer(time.monotonic(), rto, schedule(rto))
+            return True
+
+    # Remove the acknowledged packets, the one with the sequence number of the ACK
+    # and the ones covered by its ACK block (if any), cancel their retransmission timers
+    # and sample the round-trip time if the acknowledged packet wasn't retransmitted.
+    # Without a sequence number (ACK piggybacked on a data packet), the packet
+    # acknowledged is the last one acknowledged in order by the ACK block
+    def remove_packet_to_ack(self, seq_number, ack_block=None):
+        with self.lock:
+            if seq_number is None:
+                seq_number = (ack_block[0] - 1) % SEQ_MODULO
+
+            acknowledged = []
+            packet = self.packets_to_ack.pop(seq_number, None)
+            if packet is not None:
+                acknowledged.append(packet)
+                if packet.retransmissions == 0:
+                    self.rtt_estimator.add_sample(time.monotonic() - packet.sent_time)
+
+            if ack_block is not None:
+                acknowledged += pop_acknowledged(self.packets_to_ack, *ack_block)
+
+            for packet in acknowledged:
+                packet.cancel_timer()
+            if not self.packets_to_ack and not self.packets_to_send:
+                self.packets_acked.notify_all()
+
+    # Get a packet to be acknowledged by the sequence number, None if it was acknowledged
+    def get_packet_to_ack(self, seq_number):
+        with self.lock:
+            return self.packets_to_ack.get(seq_number)
 
-    # Remove the acknowledged packet by the sequence number
-    def remove_packet_to_ack(self, seq_number):
+    # Remove all packets to be acknowledged, cancelling their retransmission
+    # timers, and the packets queued to be sent
+    def clear_packets_to_ack(self):
         with self.lock:
-            self.packets_to_ack = [f_packet
-                                   for f_packet in self.packets_to_ack
-                                   if f_packet["seq_number"] != seq_number]
+            for packet in self.packets_to_ack.values():
+                packet.cancel_timer()
+            self.packets_to_ack.clear()
+            self.packets_to_send.clear()
+            self.packets_acked.notify_all()
 
     def get_packets_to_ack(self):
         with self.lock:
-            return self.packets_to_ack
+            return list(self.packets_to_ack.values())
 
+    # Number of packets to be acknowledged, including the ones queued to be sent
     def get_nr_packets_to_ack(self):
         with self.lock:
-            return len(self.packets_to_ack)
+            return len(self.packets_to_ack) + len(self.packets_to_send)
+
+    # Wait until all the packets sent and queued are acknowledged, return False on timeout
+    def wait_packets_to_ack(self, timeout=None):
+        with self.packets_acked:
+            return self.packets_acked.wait_for(
+                lambda: not self.packets_to_ack and not self.packets_to_send, timeout)
 
     ###
     # Packets received to be reordered and defragmented
     # Window size
     ###
 
+    # Add a received packet to the reassembly buffer, return the packet with
+    # the defragmented data once all the fragments of its message are
+    # received, otherwise return None to wait for the missing packets, along with
+    # the fragments rebuilt from a parity packet (FEC), added to the packets received
     def reorder_packets(self, packet):
         with self.lock:
-            # Copy the packet to ensure data encapsulation
-            copy_packet = packet.copy()
-
-            # Add the packet to the list of packets to reorder
-            self.packets_to_reorder.append(copy_packet)
-            self.agent_window_size -= 1
-
-            # Check if the defragmention/reordering is possible
-            # it is possible when all packets with sequence number,
-            # between the message id and the last fragment, are received
-            # if not possible, return None to wait for the missing packets
-
-            # get all packets to reorder/defragment
-            packets = self.packets_to_reorder
-
-            # get the received packet message id
-            message_id = packet["msg_id"]
-
-            # filter only packets with the same message id
-            packets = [
-                f_packet for f_packet in packets
-                if f_packet["msg_id"] == message_id
-            ]
-
-            # get the last fragment (if it exists)
-            # to check if all packets were received
-            last_fragment = None
-            for p in packets:
-                if p["flags"]["more_fragments"] == 0:
-                    last_fragment = p
-                    break
-
-            # if the last fragment was not received yet, return None
-            if last_fragment is None:
-                return None
-
-            # check if all packets with the same message id are received
-            # if not, return None
-            sequence_numbers = [p["seq_number"] for p in packets]
-            for i in range(message_id, last_fragment["seq_number"] + 1):
-                if i not in sequence_numbers:
-                    return None
-
-            # if the message_id is equal to sequence number of the packet
-            # with the last fragment, the message is not fragmented,
-            # return the packet as is
-            if message_id == last_fragment["seq_number"]:
-                # remove the packet from the list of packets to reorder
-                self.packets_to_reorder = [
-                    f_packet for f_packet in self.packets_to_reorder
-                    if f_packet != packet
-                ]
-                # increment the agent window size
-                self.agent_window_size += 1
-                return packet
-
-            # Fragmentation/reordering is possible
-
-            # save the packets to remove from the list of packets to reorder
-            buffered_packets = packets.copy()
-
-            # reorder packets by sequence number
-            # note: duplicated packets were already removed before calling this method
-            packets = sorted(packets, key=lambda x: x["seq_number"])
-
-            # defragment data by concatenating the data of all packets
-            packet = packets[0]
-            for i in range(1, len(packets)):
-                packet["data"] += packets[i]["data"]
-
-            # remove the defragmented packets from the list of packets to reorder
-            self.packets_to_reorder = [
-                f_packet for f_packet in self.packets_to_reorder
-                if f_packet not in buffered_packets
-            ]
-
-            # update the window size
-            self.agent_window_size += len(buffered_packets)
-
-            return packet  # packet with defragmented data
+            # the parity of a group already received isn't kept
+            if packet.parity and all(self.receive_state.is_received(seq_number)
+                                     for seq_number in packet.parity_seq_numbers):
+                return None, []
+
+            # the window size is reduced by the packets left in the buffer
+            nr_packets = len(self.packets_to_reorder)
+            packet, recovered = self.packets_to_reorder.add(packet)
+            self.agent_window_size -= len(self.packets_to_reorder) - nr_packets
+
+            for fragment in recovered:
+                self.receive_state.add(fragment.seq_number)
+
+            return packet, recovered
+
+    # Get the sequence numbers of the fragments missing from a message, the ones
+    # before the last fragment received, that weren't reported (NACK) yet, nor can
+    # be rebuilt from the parity of their group (FEC)
+    def get_missing_packets(self, msg_id):
+        with self.lock:
+            return self.packets_to_reorder.missing(msg_id, MAX_NACK_SEQ_NUMBERS,
+                                                   self.fec_group_size)
 
     ###
     # Packets received
     ###
 
+    # Add the sequence number of a received packet,
+    # return False if the packet was already received (duplicated)
     def add_packet_received(self, seq_number):
         with self.lock:
-            # Add the sequence number to the list of packets received
-            self.packets_received.append(seq_number)
+            return self.receive_state.add(seq_number)
 
     def is_packet_received(self, seq_number):
         with self.lock:
-            return seq_number in self.packets_received
+            return self.receive_state.is_received(seq_number)
+
+    # Check if a received packet is within the window of sequence numbers tracked,
+    # the packets ahead of it are discarded without an ACK
+    def is_packet_in_window(self, seq_number):
+        with self.lock:
+            return self.receive_state.in_window(seq_number)
+
+    ###
+    # Cumulative and selective ACKs
+    ###
+
+    def get_ack_block(self):
+        with self.lock:
+            return self.receive_state.ack_block()
+
+    # Check if the ACK of a received packet can be delayed, only new packets
+    # received in order, neither urgent nor retransmitted, are acknowledged later,
+    # unless the window is closed, as the server waits for the ACKs to send more
+    def can_delay_ack(self, packet):
+        with self.lock:
+            if C.NET_TASK_VERSION not in SACK_VERSIONS:
+                return False
+            return (packet.urgent == 0 and packet.retransmission == 0
+                    and self.receive_state.is_in_order() and self.agent_window_size > 0)
+
+    ###
+    # Server round-trip time and retransmission timeout
+    ###
+
+    def get_rto(self):
+        with self.lock:
+            return self.rtt_estimator.rto
+
+    def backoff_rto(self, expired_rto):
+        with self.lock:
+            self.rtt_estimator.backoff(expired_rto)
 
     ###
     # Agent window size
@@ -180,3 +259,25 @@ class Pool:
     def set_server_window_size(self, window_size):
         with self.lock:
             self.server_window_size = window_size
+            if window_size > 0:
+                self.server_window_open.notify_all()
+
+    # Wait until the server window size is open (greater than 0),
+    # return False if the timeout expires first
+    def wait_server_window(self, timeout=None):
+        with self.lock:
+            return self.server_window_open.wait_for(lambda: self.server_window_size > 0,
+                                                    timeout)
+
+    ###
+    # Forward error correction
+    ###
+
+    def get_fec_group_size(self):
+        with self.lock:
+            return self.fec_group_size
+
+    # Set the group size proposed to the server on the first connection
+    def set_fec_group_size(self, fec_group_size):
+        with self.lock:
+            self.fec_group_size = negotiate_group_size(fec_group_size)
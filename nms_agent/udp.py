@@ -1,11 +1,12 @@
 import socket
 import threading
-import time
 import json
 
 import constants as C
 
-from protocol.net_task import NetTask
+from protocol.net_task import NetTask, peek_identifier
+from protocol.timer    import TimerService
+from protocol.workers  import WorkerPool
 
 # NetTask exceptions
 from protocol.exceptions.invalid_version   import InvalidVersionException
@@ -14,7 +15,8 @@ from protocol.exceptions.checksum_mismatch import ChecksumMismatchException
 
 
 class UDP(threading.Thread):
-    def __init__(self, agent_id, server_ip, pool, client_task, verbose=False):
+    def __init__(self, agent_id, server_ip, pool, client_task, verbose=False,
+                 workers=C.AGENT_UDP_WORKERS, fec_group_size=C.FEC_GROUP_SIZE):
         super().__init__(daemon=True)
         self.agent_id = agent_id
         self.server_ip = server_ip
@@ -29,66 +31,123 @@ class UDP(threading.Thread):
         self.threads = []
         self.verbose = verbose
 
-        # Initialize the retransmit thread
-        ret_thread = threading.Thread(target=self.retransmit_packets)
-        self.threads.append(ret_thread)
-        ret_thread.start()
+        # Parity packets (FEC) per group of fragments, proposed to the server
+        self.pool.set_fec_group_size(fec_group_size)
 
-        # Initialize the window size control thread
-        win_thread = threading.Thread(target=self.window_size_control)
-        self.threads.append(win_thread)
-        win_thread.start()
+        # Initialize the timer service, for retransmissions, window probes and EOC timeouts
+        self.timers = TimerService()
+        self.threads.append(self.timers)
+        self.timers.start()
+
+        # Initialize the workers handling the datagrams received
+        self.workers = WorkerPool(workers, C.UDP_QUEUE_SIZE, name="udp-agent")
+        self.workers.start()
+
+        # Window probe timer, while the server window size is 0
+        self.window_probe = None
+
+        # Delayed ACK timer, while there are packets yet to be acknowledged
+        self.delayed_ack = None
 
     # NOTE retransmission of packets does not increment the sequence number
-    def retransmit_packets(self):
-        while not self.shutdown_flag.is_set():
-            # Sleep for a while before retransmitting the packets
-            time.sleep(C.RETRANSMIT_SLEEP_TIME)
-            if self.shutdown_flag.is_set():
-                break
+    # Packets are retransmitted as they were first sent, with the original sequence
+    # number, when their own retransmission timer expires
+    def retransmit_timeout(self, packet):
+        # the packet can be acknowledged after its timer expired, while it runs
+        if self.pool.get_packet_to_ack(packet.seq_number) is not packet:
+            return
 
-            # Get the packets to retransmit and retransmit them
-            packets = self.pool.get_packets_to_ack()
-            for packet in packets:
-                # build the packet to be retransmitted and set the retransmission flag
-                seq_number = self.pool.get_seq_number()
-                window_size = self.pool.get_agent_window_size()
-                flags = packet["flags"]
-                flags["retransmission"] = 1
-                _, ret_packets = self.net_task.build_packet(
-                    self.net_task, packet["data"],
-                    seq_number, flags,
-                    packet["msg_type"], self.agent_id,
-                    window_size)
-
-                # wait if the server window size is 0 and the URG flag is not set
-                urgent = flags.get("urgent", 0)
-                if urgent == 0:
-                    while self.pool.get_server_window_size() >= 0:
-                        time.sleep(1)
-
-                for ret_packet in ret_packets:
-                    with self.lock:
-                        self.client_socket.sendto(ret_packet, (self.server_ip, C.UDP_PORT))
+        # the packets in flight were already admitted by the server window size,
+        # so they're retransmitted even if the window is closed meanwhile
+
+        # the retransmission timeout is doubled from the expired timeout
+        self.pool.backoff_rto(packet.rto)
+        rto = self.pool.get_rto()
+
+        self.retransmit(packet, rto)
+
+    # Retransmit the packets reported as missing (NACK) by the server right away,
+    # without waiting for their retransmission timers nor backing off the timeout
+    def fast_retransmit(self, seq_numbers):
+        rto = self.pool.get_rto()
+        for seq_number in seq_numbers:
+            packet = self.pool.get_packet_to_ack(seq_number)
+            if packet is None:
+                continue  # already acknowledged
+            packet.cancel_timer()
+            self.retransmit(packet, rto)
+
+    def retransmit(self, packet, rto):
+        # restart the retransmission timer and set the retransmission flag,
+        # unless the packet was acknowledged meanwhile
+        if not self.start_retransmit_timer(packet, rto):
+            return
+        packet.set_retransmission_flag()
 
-                    if self.verbose:
-                        print(f"Retransmitting packet: {json.dumps(packet, indent=2)}")
+        with self.lock:
+            self.client_socket.sendmsg(packet.buffers, [], 0, (self.server_ip, C.UDP_PORT))
 
-    def window_size_control(self):
-        while not self.shutdown_flag.is_set():
-            # Sleep for a while before probing the window size
-            time.sleep(C.WINDOW_PROBE_SLEEP_TIME)
-            if self.shutdown_flag.is_set():
-                break
+        if self.verbose:
+            print(f"Retransmitting packet: {json.dumps(packet.to_dict(), indent=2)}")
 
-            # Get the window size of the server
-            window_size = self.pool.get_server_window_size()
-            if window_size <= 0:
-                self.send("", {"urgent": 1, "window_probe": 1},
-                          self.net_task.UNDEFINED)
+    # Start the retransmission timer of a packet, return False if it was acknowledged
+    def start_retransmit_timer(self, packet, rto):
+        return self.pool.set_retransmit_timer(
+            packet, rto, lambda rto: self.timers.schedule(rto, self.retransmit_timeout, packet))
 
-                if self.verbose:
-                    print("Sending window probe to server")
+    # Delay the ACK of a packet, the ACK is sent when the timer expires, unless
+    # it's piggybacked on a data packet sent to the server meanwhile. The ACK block
+    # sent acknowledges all the packets received from the server until then
+    def start_delayed_ack(self, packet):
+        with self.lock:
+            if self.delayed_ack is None:
+                self.delayed_ack = self.timers.schedule(C.DELAYED_ACK_TIMEOUT,
+                                                        self.delayed_ack_timeout, packet)
+
+    def delayed_ack_timeout(self, packet):
+        if self.cancel_delayed_ack():
+            self.send_ack(packet)
+
+    # Cancel the delayed ACK, return False if there was none pending
+    def cancel_delayed_ack(self):
+        with self.lock:
+            timer, self.delayed_ack = self.delayed_ack, None
+        if timer is None:
+            return False
+        timer.cancel()
+        return True
+
+    # Probe the window size of the server periodically, while it's 0 or less
+    def start_window_probe(self):
+        with self.lock:
+            if self.window_probe is None:
+                self.window_probe = self.timers.schedule(C.WINDOW_PROBE_SLEEP_TIME,
+                                                         self.window_probe_timeout)
+
+    def window_probe_timeout(self):
+        with self.lock:
+            self.window_probe = None
+
+        if self.pool.get_server_window_size() > 0:
+            return
+
+        self.send("", {"urgent": 1, "window_probe": 1},
+                  self.net_task.UNDEFINED)
+
+        if self.verbose:
+            print("Sending window probe to server")
+
+        self.start_window_probe()
+
+    # Give up on the packets not acknowledged, when the server
+    # didn't acknowledge the end of connection in time
+    def eoc_timeout(self):
+        self.pool.clear_packets_to_ack()
+
+    # Window size advertised to the server, the buffer space left
+    # less the packets received still queued to be handled
+    def get_window_size(self):
+        return self.pool.get_agent_window_size() - len(self.workers)
 
     def run(self):
         while not self.shutdown_flag.is_set():
@@ -97,13 +156,13 @@ class UDP(threading.Thread):
                 if not raw_data:
                     break
 
-                # Create a thread to handle the packet
-                handle_packet_thread = threading.Thread(target=self.handle_packet,
-                                                        args=(raw_data,))
-                self.threads.append(handle_packet_thread)
-                handle_packet_thread.start()
-                # INFO To process the packets sequentially, join the thread
-                # handle_packet_thread.join()
+                # Queue the packet to be handled by the worker of the server lane, after
+                # the packets received before from the same server, it's dropped if the
+                # lane is full and retransmitted later, as it isn't acknowledged
+                if not self.workers.submit(peek_identifier(raw_data), self.handle_packet,
+                                           raw_data):
+                    if self.verbose:
+                        print("Handler lane full, dropping packet")
             except socket.timeout:
                 continue
             except OSError:
@@ -123,39 +182,72 @@ class UDP(threading.Thread):
             return
 
         if self.verbose:
-            print(f"Received packet: {json.dumps(packet, indent=2)}")
+            print(f"Received packet: {json.dumps(packet.to_dict(), indent=2)}")
 
         # Save the received server window size
-        self.pool.set_server_window_size(packet["window_size"])
+        self.pool.set_server_window_size(packet.window_size)
+        if packet.window_size <= 0:
+            self.start_window_probe()
+
+        # If the packet received is a NACK, retransmit the packets listed as missing
+        # by the server. NACKs aren't acknowledged, so we interrupt this function.
+        if packet.msg_type == self.net_task.NACK:
+            self.fast_retransmit(packet.nack_seq_numbers)
+            return
 
         # If the packet received is a ACK, process the previous packet sent
         # as acknowledged and remove it from the list of packets to be "acked",
-        # for that specific agent. After that we interrupt this function.
-        if packet["flags"]["ack"] == 1:
-            self.pool.remove_packet_to_ack(packet["seq_number"])
-            return
-
-        # send ACK
-        window_size = self.pool.get_agent_window_size()
-        ack_packet = self.net_task.build_ack_packet(packet, self.agent_id, window_size)
-
-        with self.lock:
-            self.client_socket.sendto(ack_packet, (self.server_ip, C.UDP_PORT))
-
-        # whenever the agent receives a duplicated packet,
-        # the ack is sent, but the packet is discarded
-        if self.pool.is_packet_received(packet["seq_number"]):
+        # for that specific agent, along with the packets covered by its ACK block.
+        # After that we interrupt this function, unless the ACK is piggybacked
+        # on a data packet, which is processed as any other packet.
+        # The packets queued are sent as the acknowledged packets leave the window.
+        if packet.ack == 1:
+            if not packet.piggybacked:
+                self.pool.remove_packet_to_ack(packet.seq_number, packet.ack_block)
+                self.send_packets()
+                return
+            self.pool.remove_packet_to_ack(None, packet.ack_block)
+            self.send_packets()
+
+        # discard the packets ahead of the window of sequence numbers tracked,
+        # without an ACK, so the server retransmits them later
+        if not self.pool.is_packet_in_window(packet.seq_number):
             return
 
-        # Add the sequence number to the list of received packets
-        self.pool.add_packet_received(packet["seq_number"])
-
-        # Increment the sequence number
-        self.pool.inc_seq_number()
-
-        # Packet reordering and defragmentation
-        packet = self.pool.reorder_packets(packet)
+        # parity packets (FEC) don't take a sequence number and aren't acknowledged
+        if not packet.parity:
+            # Add the sequence number to the list of received packets,
+            # before sending the ACK so its ACK block covers this packet
+            duplicated = not self.pool.add_packet_received(packet.seq_number)
+
+            # send ACK, unless it can be delayed to be coalesced or piggybacked
+            if duplicated or not self.pool.can_delay_ack(packet):
+                self.send_ack(packet)
+            else:
+                self.start_delayed_ack(packet)
+
+            # whenever the agent receives a duplicated packet,
+            # the ack is sent, but the packet is discarded. An EOC is handled anyway,
+            # as a server that adopted the agent restarts its sequence numbers
+            if duplicated:
+                if packet.msg_type == self.net_task.EOC:
+                    self.shutdown_flag.set()
+                return
+
+        # Packet reordering and defragmentation, a fragment rebuilt from the parity
+        # of its group is acknowledged as received, so the server doesn't retransmit it
+        msg_id = packet.msg_id
+        packet, recovered = self.pool.reorder_packets(packet)
+        for fragment in recovered:
+            self.send_ack(fragment)
+            if self.verbose:
+                print(f"Recovered packet {fragment.seq_number} (FEC)")
         if packet is None:
+            # report the fragments missing before the ones received (NACK),
+            # so the server retransmits them without waiting for their timers
+            missing = self.pool.get_missing_packets(msg_id)
+            if missing:
+                self.send_nack(missing, msg_id)
             if self.verbose:
                 print("Adding packet to defrag/reorder array")
             return  # wait for the missing packets
@@ -165,58 +257,119 @@ class UDP(threading.Thread):
         # - EOC (End of Connection): send a ACK and shutdown the agent
         # - Undefined: defragmented packet if not a window probe
         eoc_received = False
-        match packet["msg_type"]:
+        match packet.msg_type:
             case self.net_task.SEND_TASKS:
                 # Add the task to the loaded tasks list
                 if self.verbose:
                     print("Received task")
                 # Parse json data to dict
-                data = json.loads(packet["data"])
+                data = json.loads(packet.text)
                 self.client_task.add_task(data)
             case self.net_task.EOC:
                 eoc_received = True
             case self.net_task.UNDEFINED:
-                window_probe = packet["flags"].get("window_probe", 0)
+                window_probe = packet.window_probe
                 if window_probe == 0 and self.verbose:
-                    print(f"Defragmented packet: {json.dumps(packet, indent=2)}")
+                    print(f"Defragmented packet: {json.dumps(packet.to_dict(), indent=2)}")
 
         if eoc_received:
             self.shutdown_flag.set()
 
-    def send(self, data, flags, msg_type):
-        seq_number = self.pool.get_seq_number()
-        window_size = self.pool.get_agent_window_size()
-        seq_number, packets = self.net_task.build_packet(self.net_task, data, seq_number, flags,
-                                                         msg_type, self.agent_id, window_size)
+    def send_ack(self, packet):
+        # this ACK also acknowledges the packets of a delayed ACK
+        self.cancel_delayed_ack()
 
-        # set the sequence number
-        self.pool.set_seq_number(seq_number)
+        window_size = self.get_window_size()
+        ack_block = self.pool.get_ack_block()
+        ack_packet = self.net_task.build_ack_packet(packet, self.agent_id, window_size, ack_block)
+
+        with self.lock:
+            self.client_socket.sendto(ack_packet, (self.server_ip, C.UDP_PORT))
+
+    def send_nack(self, seq_numbers, msg_id):
+        window_size = self.get_window_size()
+        nack_packet = self.net_task.build_nack_packet(seq_numbers, msg_id, self.agent_id,
+                                                      window_size)
+
+        with self.lock:
+            self.client_socket.sendto(nack_packet, (self.server_ip, C.UDP_PORT))
 
+        if self.verbose:
+            print(f"Sending NACK for packets {seq_numbers}")
+
+    def send(self, data, flags, msg_type):
         # Flux control by checking the window size
         # if the URG flag is set, send the packet immediately, regardless of the window size
         # if the window size received is 0, the window size control thread will send window probe
         # packets to the server
         urgent = flags.get("urgent", 0)
         if urgent == 0:
-            while self.pool.get_server_window_size() <= 0:
-                time.sleep(1)
+            while not self.pool.wait_server_window(timeout=1):
                 if self.verbose:
                     print("Server window size is 0 or less. Waiting...")
 
+        # piggyback the delayed ACK, if any, on the data sent, unless
+        # the data is queued behind other packets waiting for the window
+        ack_block = None
+        if data and self.pool.can_send_packets() and self.cancel_delayed_ack():
+            ack_block = self.pool.get_ack_block()
+
+        # the fragments of the messages queued are protected by parity packets (FEC),
+        # if proposed to the server
+        fec_group_size = self.pool.get_fec_group_size() if urgent == 0 else 0
+
+        seq_number = self.pool.get_seq_number()
+        window_size = self.get_window_size()
+        seq_number, fragments = self.net_task.build_fragments(self.net_task, data, seq_number,
+                                                              flags, msg_type, self.agent_id,
+                                                              window_size, ack_block,
+                                                              fec_group_size)
+
+        # set the sequence number
+        self.pool.set_seq_number(seq_number)
+
+        # urgent packets are sent right away, the others are queued and sent as the
+        # server window size allows, the next ones being sent as the ACKs arrive
+        if urgent == 0:
+            self.pool.queue_packets_to_send(fragments)
+            self.send_packets()
+            return
+
+        rto = self.pool.get_rto()
+        for packet in fragments:
+            # add the packet to the list of packets to be acknowledged and start the
+            # retransmission timer before sending, as the ACK can arrive first
+            self.pool.add_packet_to_ack(packet)
+            self.start_retransmit_timer(packet, rto)
+            self.send_packet(packet)
+
+    # Send the packets queued that fit in the server window size
+    def send_packets(self):
+        packets = self.pool.take_packets_to_send()
+        if not packets:
+            return
+
+        rto = self.pool.get_rto()
         for packet in packets:
-            with self.lock:
-                self.client_socket.sendto(packet, (self.server_ip, C.UDP_PORT))
+            self.start_retransmit_timer(packet, rto)
+            self.send_packet(packet)
 
-            # parse the packet to save it in the list of packets to be acknowledged
-            tmp_packet = self.net_task.parse_packet(self.net_task, packet)
-            # add the packet to the list of packets to be acknowledged
-            self.pool.add_packet_to_ack(tmp_packet)
+    # Send a packet for the first time, followed by the parity packet
+    # of its group (FEC), if it's the last fragment of the group
+    def send_packet(self, packet):
+        with self.lock:
+            self.client_socket.sendmsg(packet.buffers, [], 0, (self.server_ip, C.UDP_PORT))
+            if packet.parity_packet is not None:
+                self.client_socket.sendmsg(packet.parity_packet.buffers, [], 0,
+                                           (self.server_ip, C.UDP_PORT))
 
-            if self.verbose:
-                print(f"Sending packet: {json.dumps(tmp_packet, indent=2)}")
+        if self.verbose:
+            print(f"Sending packet: {json.dumps(packet.to_dict(), indent=2)}")
 
+    # The first connection proposes the FEC group size to the server, if enabled
     def send_first_connection(self):
-        data = ""
+        fec_group_size = self.pool.get_fec_group_size()
+        data = json.dumps({"fec_group_size": fec_group_size}) if fec_group_size else ""
         flags = {"urgent": 1}
         msg_type = self.net_task.FIRST_CONNECTION
 
@@ -235,9 +388,13 @@ class UDP(threading.Thread):
 
         self.send(data, flags, msg_type)
 
+        # Give up if the EOC isn't acknowledged in time
+        self.timers.schedule(C.EOC_ACK_TIMEOUT, self.eoc_timeout)
+
     def shutdown(self):
         # Signal all threads to stop
         self.shutdown_flag.set()
+        self.timers.shutdown()
 
         # Close the socket
         try:
@@ -245,6 +402,10 @@ class UDP(threading.Thread):
         except OSError as e:
             print(f"Error closing UDP socket: {e}")
 
+        # Stop the workers once the packets queued are handled
+        self.workers.shutdown()
+        self.workers.join()
+
         # Wait for all threads to finish
         for thread in self.threads:
             if thread.is_alive():
@@ -6,14 +6,15 @@ import sys
 import argparse
 import time
 
-
-from constants import EOC_ACK_TIMEOUT
+import constants as C
 
 from nms_server import (
     ServerUI,
     ServerPool,
     TCPServer,
     UDPServer,
+    AsyncUDPServer,
+    UDPShards,
     TaskServer,
     Config
 )
@@ -28,6 +29,18 @@ def main():
     arg_parser.add_argument("-v", "--verbose",
                             help="Enable verbose output",
                             action="store_true")
+    arg_parser.add_argument("-w", "--udp-workers",
+                            help="Number of threads handling the UDP packets received",
+                            type=int,
+                            default=C.UDP_WORKERS)
+    arg_parser.add_argument("-e", "--engine",
+                            help="Engine of the NetTask and AlertFlow servers",
+                            choices=["threads", "asyncio"],
+                            default="threads")
+    arg_parser.add_argument("--workers",
+                            help="Number of NetTask server processes, sharing the UDP port",
+                            type=int,
+                            default=1)
     args = arg_parser.parse_args()
 
     # Load the configuration file
@@ -42,14 +55,26 @@ def main():
     pool = ServerPool()
     task_server = TaskServer(config)
 
-    ui = ServerUI(server_hostname, pool, verbose=args.verbose)
+    ui = ServerUI(server_hostname, verbose=args.verbose)
     ui.display_title()
 
     tcp_server = TCPServer(ui, verbose=args.verbose)
-    udp_server = UDPServer(ui, pool, task_server, verbose=args.verbose)
-
-    tcp_server.start()
-    udp_server.start()
+    if args.workers > 1:
+        # The agents are partitioned among the NetTask server processes
+        udp_server = UDPShards(ui, config, args.workers, verbose=args.verbose,
+                               engine=args.engine, workers=args.udp_workers)
+        servers = [tcp_server, udp_server]
+    elif args.engine == "asyncio":
+        # The AlertFlow connections are served by the event loop of the NetTask server
+        udp_server = AsyncUDPServer(ui, pool, task_server, tcp_server, verbose=args.verbose)
+        servers = [udp_server]
+    else:
+        udp_server = UDPServer(ui, pool, task_server, verbose=args.verbose,
+                               workers=args.udp_workers)
+        servers = [tcp_server, udp_server]
+
+    for server in servers:
+        server.start()
 
     try:
         ui.main_menu(tcp_server, udp_server, config)
@@ -57,21 +82,22 @@ def main():
         ui.display_info("Server interrupted. Shutting down...")
     finally:
         # Send EOC to all agents and await until the agents send the ACK
-        # or after some seconds, if the agents don't respond, shutdown the server
+        # or after some seconds, if the agents don't respond, shutdown the server.
+        # The agents connected after the EOC was sent don't get an EOC timer,
+        # so the wait is bounded for all the agents
         udp_server.send_end_of_connection()
         start_time = time.time()
-        while (pool.get_nr_packets_to_ack() > 0 and
-               time.time() - start_time < EOC_ACK_TIMEOUT):
+        while (not pool.wait_packets_to_ack(timeout=1)
+               and time.time() - start_time < C.EOC_ACK_TIMEOUT):
             if args.verbose:
                 print(f"Nr of packs to be acknowledged: {pool.get_nr_packets_to_ack()}")
                 print(f"Time elapsed: {time.time() - start_time}")
-            time.sleep(1)
 
         # Shutdown the servers and await until the threads finish
-        tcp_server.shutdown()
         udp_server.shutdown()
-        tcp_server.join()
-        udp_server.join()
+        tcp_server.shutdown()
+        for server in servers:
+            server.join()
 
         # Display the active threads if verbose mode is enabled
         if (args.verbose):
@@ -2,6 +2,8 @@ from .ui     import UI     as ServerUI
 from .pool   import Pool   as ServerPool
 from .tcp    import TCP    as TCPServer
 from .udp    import UDP    as UDPServer
+from .aio    import AsyncUDP as AsyncUDPServer
+from .shards import Shards as UDPShards
 from .task   import Task   as TaskServer
 from .config import Config
 
@@ -10,6 +12,8 @@ __all__ = [
     "ServerPool",
     "TCPServer",
     "UDPServer",
+    "AsyncUDPServer",
+    "UDPShards",
     "TaskServer",
     "Config"
 ]
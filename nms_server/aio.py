@@ -0,0 +1,129 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import constants as C
+
+from protocol.timer import LoopTimers
+
+from .udp import UDP
+
+
+# NetTask and AlertFlow servers on a single asyncio event loop, as an alternative
+# to the threaded servers. The datagrams are handled as they are received by the
+# loop, in order, and the timers are scheduled on the loop, so there are no worker
+# nor timer threads. The AlertFlow connections are served by the same loop, with
+# the sockets bound by the TCP and UDP servers, unless there is no TCP server.
+# The status, metrics and alerts are saved (in the database) by a writer thread,
+# so the loop isn't blocked by the database while serving the other agents.
+
+
+# UI of the servers on the loop, the status and metrics are saved by the writer
+# thread, in the order they are received, the other calls go to the UI
+class WriterUI:
+    def __init__(self, ui, writer):
+        self.ui = ui
+        self.writer = writer
+
+    def save_status(self, message):
+        self.writer.submit(self.save, self.ui.save_status, message)
+
+    def save_metrics(self, hostname, metrics):
+        self.writer.submit(self.save, self.ui.save_metrics, hostname, metrics)
+
+    def save(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"Error running {callback.__name__}: {e}")
+
+    def __getattr__(self, name):
+        return getattr(self.ui, name)
+
+
+class AsyncUDP(UDP, asyncio.DatagramProtocol):
+    def __init__(self, ui, pool, task_server, tcp_server, verbose=False, host='0.0.0.0',
+                 server_socket=None, adopt_clients=False):
+        self.loop = asyncio.new_event_loop()
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                            thread_name_prefix="db-writer")
+        super().__init__(WriterUI(ui, self.writer), pool, task_server, verbose, host,
+                         server_socket=server_socket, adopt_clients=adopt_clients)
+        self.tcp_server = tcp_server
+        self.transport = None
+        self.alert_server = None
+
+    def create_timers(self):
+        return LoopTimers(self.loop)
+
+    # The packets are handled by the loop
+    def create_workers(self, workers):
+        return None
+
+    def send_datagram(self, buffers, addr):
+        data = b"".join(buffers)
+        if threading.current_thread() is self:
+            self.transport.sendto(data, addr)
+        else:
+            self.loop.call_soon_threadsafe(self.transport.sendto, data, addr)
+
+    def get_window_size(self, agent_id):
+        return self.pool.get_server_window_size(agent_id)
+
+    def get_handler_stats(self):
+        return 0, 0
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+            self.loop.run_forever()
+        finally:
+            if self.alert_server is not None:
+                self.alert_server.close()
+                self.loop.run_until_complete(self.alert_server.wait_closed())
+            if self.transport is not None:
+                self.transport.close()
+            self.loop.close()
+            # save the status and metrics left
+            self.writer.shutdown()
+
+    async def serve(self):
+        await self.loop.create_datagram_endpoint(lambda: self, sock=self.server_socket)
+        if self.tcp_server is None:
+            return
+        self.alert_server = await asyncio.start_server(self.handle_connection,
+                                                       sock=self.tcp_server.server_socket)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            self.handle_packet(data, addr)
+        except Exception as e:
+            print(f"Error handling packet from {addr}: {e}")
+
+    def error_received(self, exc):
+        self.ui.display_error(f"UDP error: {exc}")
+
+    # The alerts are handled (and saved) by the writer thread
+    async def handle_connection(self, reader, writer):
+        self.ui.save_status(f"TCP connection received from {writer.get_extra_info('peername')}")
+        try:
+            while not self.shutdown_flag.is_set():
+                raw_data = await reader.read(C.BUFFER_SIZE)
+                if not raw_data or not await self.loop.run_in_executor(
+                        self.writer, self.tcp_server.handle_alerts, raw_data):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # Stop the loop and wait for the servers to be closed
+    def shutdown(self):
+        self.shutdown_flag.set()
+        if self.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.join()
@@ -1,235 +1,674 @@
 import threading
+import time
+
+from collections import deque
+from types import MappingProxyType
+
+import constants as C
 
 from constants import INITIAL_WINDOW_SIZE
+from protocol.congestion import CongestionWindow, TokenBucket, pacing_rate
+from protocol.fec import negotiate_group_size
+from protocol.net_task import MAX_NACK_SEQ_NUMBERS, SACK_VERSIONS
+from protocol.reassembly import ReassemblyBuffer
+from protocol.rtt import RTTEstimator
+from protocol.sack import ReceiveState, SEQ_MODULO, pop_acknowledged
+
+
+# Session of an agent, with its own lock, so the packets of different
+# agents are handled without contending for a single lock
+class AgentSession:
+    __slots__ = ("addr", "seq_number", "packets_to_ack", "packets_to_send",
+                 "packets_to_retransmit", "packets_to_reorder",
+                 "receive_state", "window_size", "rtt_estimator", "congestion", "pacer",
+                 "fec_group_size", "lock")
+
+    def __init__(self):
+        self.addr               = None                 # Address, None while not connected
+        self.seq_number         = 1                    # Next sequence number to send
+        self.packets_to_ack     = dict()               # Packets sent, by sequence number
+        self.packets_to_send    = deque()              # Packets waiting for the agent window
+        self.packets_to_retransmit = dict()            # Packets waiting for the congestion window
+        self.packets_to_reorder = ReassemblyBuffer()   # Packets received to be defragmented
+        self.receive_state      = None                 # Window of sequence numbers received
+        self.window_size        = INITIAL_WINDOW_SIZE  # Agent window size
+        self.rtt_estimator      = RTTEstimator()       # Round-trip time estimator
+        self.congestion         = CongestionWindow()   # Congestion window
+        self.pacer              = TokenBucket(None, C.PACING_BURST, time.monotonic())
+        self.fec_group_size     = 0                    # Fragments per parity group (FEC)
+        self.lock               = threading.Lock()
+
+    @property
+    def connected(self):
+        return self.addr is not None
+
+    # Number of packets allowed in flight, bounded by the agent window size and the
+    # congestion window. A packet is kept in flight while the window is closed, as
+    # the window can be taken by the fragments of a message that only completes
+    # with the next ones
+    @property
+    def send_window(self):
+        return min(max(self.window_size, 1), self.congestion.window)
+
+    # Update the pacing rate, after the congestion window or the RTT change
+    def update_pacing_rate(self, now):
+        self.pacer.set_rate(pacing_rate(self.congestion, self.rtt_estimator.srtt), now)
+
+
+# Share of the server window size taken by the fragments buffered of an agent,
+# bounded by the window size of an agent, so a single agent can't take the server
+# window size from the others
+def window_share(nr_fragments):
+    return min(nr_fragments, C.AGENT_WINDOW_SIZE)
 
 
 class Pool:
-    # List of connected agents and respective addresses
-    # List of sequence number of each agent
-    # List of packets sent yet to be acknowledged by each agent
-    # List of packets received yet to be reordered and defragmented
-    # List of sequence numbers of packets received (for descarting duplicates)
-    # Server buffer size (window size)
-    # List of agents window sizes
+    # Registry of the agents sessions
+    # Snapshot of the connected agents and respective addresses
+    # Number of packets yet to be acknowledged by all the agents, including the queued ones
+    # Server buffer size (window size), shared by all the agents
+    # Size of the fragments buffered to be reassembled, of all the agents
+    # Number of partial messages and fragments evicted, and of fragments over budget
+    #
+    # The pool lock only guards the registry and the counters shared by all the agents,
+    # the state of each agent is guarded by the lock of its session. When both are
+    # needed, the session lock is acquired first.
     def __init__(self):
-        self.clients = dict()
-        self.seq_numbers = dict()
-        self.packets_to_ack = dict()
-        self.packets_to_reorder = dict()
-        self.packets_received = dict()
-        self.agents_window_sizes = dict()
-        self.server_window_size = INITIAL_WINDOW_SIZE
+        self.sessions = dict()
+        self.connected_clients = MappingProxyType({})
+        self.nr_packets_to_ack = 0
+        self.server_window_size = C.SERVER_WINDOW_SIZE
+        self.reassembly_bytes = 0
+        self.evicted_messages = 0
+        self.evicted_fragments = 0
+        self.dropped_fragments = 0
         self.lock = threading.Lock()
+        # Notified when all the packets sent are acknowledged
+        self.packets_acked = threading.Condition(self.lock)
 
     ###
-    # Clients
+    # Sessions
     ###
 
-    def add_client(self, client, addr):
-        with self.lock:
-            self.clients[client] = addr
-            self.seq_numbers[client] = 1
-            self.packets_to_ack[client] = []
+    # Get the session of an agent, None if the agent isn't connected
+    def get_session(self, client):
+        return self.sessions.get(client)
 
-            # The packets to reorder can be already created by the server
-            # for that client, so we need to check if it exists before creating
-            # This is necessary because the server can receive packets out of order
-            if client not in self.packets_to_reorder:
-                self.packets_to_reorder[client] = []
+    def get_or_create_session(self, client):
+        session = self.sessions.get(client)
+        if session is None:
+            with self.lock:
+                session = self.sessions.setdefault(client, AgentSession())
+        return session
 
-            self.packets_received[client] = []
+    ###
+    # Clients
+    ###
 
-            self.agents_window_sizes[client] = INITIAL_WINDOW_SIZE
+    # The sequence number is the one of the first connection packet,
+    # the first packet sent by the agent
+    def add_client(self, client, addr, seq_number):
+        session = self.get_or_create_session(client)
+        with session.lock:
+            # cancel the retransmission timers of a previous session
+            self.clear_packets_to_ack(session)
+
+            session.addr = addr
+            session.seq_number = 1
+            session.receive_state = ReceiveState(seq_number)
+            session.window_size = INITIAL_WINDOW_SIZE
+            session.rtt_estimator = RTTEstimator()
+            session.congestion = CongestionWindow()
+            session.pacer = TokenBucket(None, C.PACING_BURST, time.monotonic())
+            session.fec_group_size = 0
+
+            with self.lock:
+                self.publish_connected_clients(client, addr)
 
     def remove_client(self, client):
-        with self.lock:
-            if client not in self.clients:
-                return
-            del self.clients[client]
-            del self.seq_numbers[client]
-            del self.packets_to_ack[client]
-            del self.packets_to_reorder[client]
-            del self.packets_received[client]
-            del self.agents_window_sizes[client]
-
+        session = self.sessions.get(client)
+        if session is None or not session.connected:
+            return
+
+        with session.lock:
+            # cancel the retransmission timers of the packets not acknowledged
+            self.clear_packets_to_ack(session)
+            session.addr = None
+
+            # the packets left to be defragmented no longer take space in the server buffer
+            with self.lock:
+                self.server_window_size += window_share(len(session.packets_to_reorder))
+                self.reassembly_bytes -= session.packets_to_reorder.nr_bytes
+                if self.sessions.get(client) is session:
+                    del self.sessions[client]
+                self.publish_connected_clients(client, None)
+
+    def is_client_connected(self, client):
+        session = self.sessions.get(client)
+        return session is not None and session.connected
+
+    def get_client_address(self, client):
+        session = self.sessions.get(client)
+        return session.addr if session is not None else None
+
+    # The connected agents are read from an immutable snapshot, without the lock,
+    # the snapshot is replaced only when an agent connects or disconnects
     def get_connected_clients(self):
-        with self.lock:
-            return self.clients
+        return self.connected_clients
+
+    # Publish a new snapshot of the connected agents, a copy of the previous one with
+    # the address of an agent added or removed (None) (the pool lock must be held)
+    def publish_connected_clients(self, client, addr):
+        clients = dict(self.connected_clients)
+        if addr is None:
+            clients.pop(client, None)
+        else:
+            clients[client] = addr
+        self.connected_clients = MappingProxyType(clients)
+
+    # State of the connected agents, by agent, shown by the UI. Only plain values,
+    # to be sent by the shards to the parent process
+    def get_clients_stats(self):
+        stats = dict()
+        for client, addr in self.get_connected_clients().items():
+            session = self.sessions.get(client)
+            if session is None:
+                continue
+            with session.lock:
+                estimator = session.rtt_estimator
+                stats[client] = {
+                    "address": addr,
+                    "seq_number": session.seq_number,
+                    "packets_to_ack": len(session.packets_to_ack),
+                    "packets_to_reorder": len(session.packets_to_reorder),
+                    "client_window_size": session.window_size,
+                    "congestion_window": session.congestion.window,
+                    "srtt": estimator.srtt,
+                    "rttvar": estimator.rttvar,
+                    "rto": estimator.rto
+                }
+            stats[client]["server_window_size"] = self.get_server_window_size(client)
+        return stats
 
     ###
     # Sequence numbers
     ###
 
+    # The packets sent to an agent disconnected meanwhile aren't tracked,
+    # the sequence numbers restart with the next session
     def get_seq_number(self, client):
-        with self.lock:
-            return self.seq_numbers[client]
+        session = self.sessions.get(client)
+        if session is None:
+            return 1
+        with session.lock:
+            return session.seq_number
 
     def set_seq_number(self, client, seq_number):
-        with self.lock:
-            self.seq_numbers[client] = seq_number
+        session = self.sessions.get(client)
+        if session is None:
+            return
+        with session.lock:
+            session.seq_number = seq_number
 
-    def inc_seq_number(self, client):
-        with self.lock:
-            try:
-                self.seq_numbers[client] += 1
-                return self.seq_numbers[client]
-            except KeyError:
-                return 0
+    ###
+    # Packets to be sent
+    ###
+
+    # Queue packets to be sent once they fit in the agent window size,
+    # they're counted as packets to be acknowledged from now on
+    def queue_packets_to_send(self, client, packets):
+        session = self.sessions.get(client)
+        if session is None:
+            return
+        with session.lock:
+            session.packets_to_send.extend(packets)
+            with self.lock:
+                self.nr_packets_to_ack += len(packets)
+
+    # Take the packets queued that fit in the send window of the agent, as the packets
+    # in flight (sent and not acknowledged) are bounded by the window, and that the
+    # pacing allows. The packets taken are added to the packets to be acknowledged, to
+    # be sent right away. Return the packets waiting to be retransmitted that now fit
+    # in the congestion window, the packets taken and the time until the pacing allows
+    # the next packet, or None if the next packets wait for the window
+    def take_packets_to_send(self, client):
+        session = self.sessions.get(client)
+        if session is None:
+            return [], [], None
+
+        now = time.monotonic()
+        with session.lock:
+            retransmissions = self.take_packets_to_retransmit(session)
+
+            packets = []
+            while (session.packets_to_send
+                   and len(session.packets_to_ack) < session.send_window):
+                delay = session.pacer.consume(now)
+                if delay > 0:
+                    return retransmissions, packets, delay
+
+                packet = session.packets_to_send.popleft()
+                session.packets_to_ack[packet.seq_number] = packet
+                packets.append(packet)
+            return retransmissions, packets, None
+
+    # Take the packets waiting to be retransmitted that are among the oldest packets
+    # in flight that fit in the congestion window (the session lock must be held)
+    def take_packets_to_retransmit(self, session):
+        packets = []
+        if not session.packets_to_retransmit:
+            return packets
+
+        for index, packet in enumerate(session.packets_to_ack.values()):
+            if index >= session.congestion.window:
+                break
+            if session.packets_to_retransmit.pop(packet.seq_number, None) is not None:
+                packets.append(packet)
+        return packets
+
+    # Check if a packet would be sent right away, not queued behind other packets,
+    # nor held back by the window or the pacing
+    def can_send_packets(self, client):
+        session = self.sessions.get(client)
+        if session is None:
+            return False
+        with session.lock:
+            return (not session.packets_to_send
+                    and len(session.packets_to_ack) < session.send_window
+                    and session.pacer.available(time.monotonic()))
 
     ###
     # Packets sent to be acknowledged
     ###
 
     def add_packet_to_ack(self, client, packet):
+        session = self.sessions.get(client)
+        if session is None:
+            return
+        with session.lock:
+            new_packet = packet.seq_number not in session.packets_to_ack
+            session.packets_to_ack[packet.seq_number] = packet
+            if new_packet:
+                with self.lock:
+                    self.nr_packets_to_ack += 1
+
+    # Set the retransmission timer of a packet, scheduled by the callback with the
+    # timeout, unless it was acknowledged, return False if it was. The timer is set
+    # with the session lock held, so an ACK removing the packet either cancels the
+    # timer or prevents it from being set, even if the expired timer is running
+    def set_retransmit_timer(self, client, packet, rto, schedule):
+        session = self.sessions.get(client)
+        if session is None:
+            return False
+        with session.lock:
+            if session.packets_to_ack.get(packet.seq_number) is not packet:
+                return False
+            packet.set_timer(time.monotonic(), rto, schedule(rto))
+            return True
+
+    # Remove the acknowledged packets, the one with the sequence number of the ACK
+    # and the ones covered by its ACK block (if any), cancel their retransmission timers
+    # and sample the round-trip time if the acknowledged packet wasn't retransmitted.
+    # Without a sequence number (ACK piggybacked on a data packet), the packet
+    # acknowledged is the last one acknowledged in order by the ACK block
+    def remove_packet_to_ack(self, client, seq_number, ack_block=None):
+        session = self.sessions.get(client)
+        if session is None:
+            return
+
+        if seq_number is None:
+            seq_number = (ack_block[0] - 1) % SEQ_MODULO
+
+        with session.lock:
+            acknowledged = []
+            packet = session.packets_to_ack.pop(seq_number, None)
+            if packet is not None:
+                acknowledged.append(packet)
+                if packet.retransmissions == 0:
+                    session.rtt_estimator.add_sample(time.monotonic() - packet.sent_time)
+
+            if ack_block is not None:
+                acknowledged += pop_acknowledged(session.packets_to_ack, *ack_block)
+
+            for packet in acknowledged:
+                packet.cancel_timer()
+                session.packets_to_retransmit.pop(packet.seq_number, None)
+
+            # the congestion window grows with the packets acknowledged
+            if acknowledged:
+                session.congestion.on_ack(len(acknowledged))
+                session.update_pacing_rate(time.monotonic())
+
+        self.dec_nr_packets_to_ack(len(acknowledged))
+
+    # Remove all the packets to be acknowledged of a session, cancelling their
+    # retransmission timers, and the packets queued (the session lock must be held)
+    def clear_packets_to_ack(self, session):
+        for packet in session.packets_to_ack.values():
+            packet.cancel_timer()
+        self.dec_nr_packets_to_ack(len(session.packets_to_ack) + len(session.packets_to_send))
+        session.packets_to_ack.clear()
+        session.packets_to_send.clear()
+        session.packets_to_retransmit.clear()
+
+    # Decrement the number of packets to be acknowledged, notifying
+    # the threads waiting for all to be acknowledged
+    def dec_nr_packets_to_ack(self, nr_packets):
+        if nr_packets == 0:
+            return
         with self.lock:
-            copy_packet = packet.copy()
-            self.packets_to_ack[client].append(copy_packet)
-
-    def remove_packet_to_ack(self, client, seq_number):
-        with self.lock:
-            self.packets_to_ack[client] = [f_packet
-                                           for f_packet in self.packets_to_ack[client]
-                                           if f_packet["seq_number"] != seq_number]
-
-    def get_packets_to_ack(self, client):
-        with self.lock:
-            return self.packets_to_ack[client]
+            self.nr_packets_to_ack -= nr_packets
+            if self.nr_packets_to_ack == 0:
+                self.packets_acked.notify_all()
+
+    # Get a packet to be acknowledged by the sequence number, None if it was acknowledged
+    def get_packet_to_ack(self, client, seq_number):
+        session = self.sessions.get(client)
+        if session is None:
+            return None
+        with session.lock:
+            return session.packets_to_ack.get(seq_number)
 
     def get_nr_packets_to_ack(self):
         with self.lock:
-            return sum([len(self.packets_to_ack[client])
-                        for client in self.packets_to_ack])
+            return self.nr_packets_to_ack
+
+    # Wait until all the packets sent are acknowledged, return False on timeout
+    def wait_packets_to_ack(self, timeout=None):
+        with self.packets_acked:
+            return self.packets_acked.wait_for(lambda: self.nr_packets_to_ack == 0, timeout)
 
     ###
     # Packets received to be reordered and defragmented
-    # Server window size
     ###
 
+    # Add a received packet to the reassembly buffer of the client, return the
+    # packet with the defragmented data once all the fragments of its message are
+    # received, otherwise return None to wait for the missing packets, along with
+    # the fragments rebuilt from a parity packet (FEC), added to the packets received
     def reorder_packets(self, client, packet):
+        session = self.sessions.get(client)
+        if session is None:
+            return None, []
+
+        with session.lock:
+            buffer = session.packets_to_reorder
+
+            # the parity of a group already received isn't kept
+            if packet.parity and all(session.receive_state.is_received(seq_number)
+                                     for seq_number in packet.parity_seq_numbers):
+                return None, []
+
+            # the window sizes are reduced by the packets left in the buffer
+            nr_packets, nr_bytes = window_share(len(buffer)), buffer.nr_bytes
+            packet, recovered = buffer.add(packet, time.monotonic())
+            nr_packets = window_share(len(buffer)) - nr_packets
+            nr_bytes = buffer.nr_bytes - nr_bytes
+
+            for fragment in recovered:
+                session.receive_state.add(fragment.seq_number)
+
+            with self.lock:
+                self.server_window_size -= nr_packets
+                self.reassembly_bytes += nr_bytes
+
+            return packet, recovered
+
+    # Check if a packet received fits in the reassembly budgets, of the agent and
+    # of the server, and in the partial messages of the agent, evicting the stale
+    # messages of the agent when it doesn't. The size of a packet includes the slots
+    # it adds to its message, and packets with a slot over the fragments of a message
+    # are discarded. The messages not fragmented and the duplicated packets aren't buffered.
+    # The packets out of order are discarded once the agent took its window size, or
+    # while the server window size is exhausted, the next packet expected is kept,
+    # as the agent sends it even with the window closed
+    def has_buffer_space(self, client, packet):
+        if (not packet.parity and packet.more_fragments == 0
+                and packet.msg_id == packet.seq_number):
+            return True
+
+        session = self.sessions.get(client)
+        if session is None:
+            return False
+
+        with session.lock:
+            if not packet.parity and session.receive_state.is_received(packet.seq_number):
+                return True
+
+            buffer = session.packets_to_reorder
+            size = buffer.cost(packet, C.MAX_PARTIAL_MESSAGES)
+            if size is None or buffer.nr_bytes + size > C.AGENT_REASSEMBLY_BUDGET:
+                self.evict_messages(session, time.monotonic() - C.REASSEMBLY_TTL)
+                size = buffer.cost(packet, C.MAX_PARTIAL_MESSAGES)
+
+            in_order = (not packet.parity
+                        and packet.seq_number == session.receive_state.ack_number)
+            if not in_order and len(buffer) >= C.AGENT_WINDOW_SIZE:
+                with self.lock:
+                    self.dropped_fragments += 1
+                return False
+
+            with self.lock:
+                if (size is None
+                        or buffer.nr_bytes + size > C.AGENT_REASSEMBLY_BUDGET
+                        or self.reassembly_bytes + size > C.REASSEMBLY_BUDGET
+                        or (not in_order and self.server_window_size <= 0)):
+                    self.dropped_fragments += 1
+                    return False
+                return True
+
+    # Evict the partial messages of a session without fragments received since
+    # a given time, restoring the window size (the session lock must be held)
+    def evict_messages(self, session, older_than):
+        evicted = session.packets_to_reorder.evict(older_than)
+        if not evicted:
+            return 0
+
+        nr_fragments = sum(message.received for message in evicted)
+        nr_buffered = len(session.packets_to_reorder)
         with self.lock:
-            # Copy the packet to ensure data encapsulation
-            copy_packet = packet.copy()
-
-            # Check if client exists
-            if client not in self.packets_to_reorder:
-                self.packets_to_reorder[client] = []
-
-            # Add the packet to the list of packets to reorder
-            self.packets_to_reorder[client].append(copy_packet)
-            self.server_window_size -= 1
-
-            # Check if the defragmention/reordering is possible
-            # it is possible when all packets with sequence number,
-            # between the message id and the last fragment, are received
-            # if not possible, return None to wait for the missing packets
-
-            # get all packets to reorder/defragment for the client
-            packets = self.packets_to_reorder[client]
-
-            # get the receive packet message id
-            message_id = packet["msg_id"]
-
-            # filter only packets with the same message id
-            packets = [
-                f_packet for f_packet in packets
-                if f_packet["msg_id"] == packet["msg_id"]
-            ]
-
-            # get the last fragment (if it exists)
-            # to check if all packets were received
-            last_fragment = None
-            for p in packets:
-                if p["flags"]["more_fragments"] == 0:
-                    last_fragment = p
-                    break
-
-            # if the last fragment was not received yet, return None
-            if last_fragment is None:
-                return None
+            self.server_window_size += (window_share(nr_buffered + nr_fragments)
+                                        - window_share(nr_buffered))
+            self.reassembly_bytes -= sum(message.nr_bytes for message in evicted)
+            self.evicted_messages += len(evicted)
+            self.evicted_fragments += nr_fragments
+        return len(evicted)
+
+    # Evict the partial messages of all the agents without fragments
+    # received for REASSEMBLY_TTL, return the number of messages evicted
+    def evict_stale_messages(self):
+        older_than = time.monotonic() - C.REASSEMBLY_TTL
+        with self.lock:
+            sessions = list(self.sessions.values())
 
-            # check if all packets with the same message id are received
-            # if not, return None
-            sequence_numbers = [p["seq_number"] for p in packets]
-            for i in range(message_id, last_fragment["seq_number"] + 1):
-                if i not in sequence_numbers:
-                    return None
+        evicted = 0
+        for session in sessions:
+            with session.lock:
+                evicted += self.evict_messages(session, older_than)
+        return evicted
 
-            # if the message_id is equal to sequence number of the packet
-            # with the last fragment, the message is not fragmented,
-            # return the packet as is
-            if message_id == last_fragment["seq_number"]:
-                # remove the packet from the list of packets to reorder
-                self.packets_to_reorder[client] = [
-                    f_packet for f_packet in self.packets_to_reorder[client]
-                    if f_packet != packet
-                ]
-                # increment the server window size
-                self.server_window_size += 1
-                return packet
+    # Size of the fragments buffered and the eviction counters
+    def get_reassembly_stats(self):
+        with self.lock:
+            return {
+                "buffered_bytes": self.reassembly_bytes,
+                "evicted_messages": self.evicted_messages,
+                "evicted_fragments": self.evicted_fragments,
+                "dropped_fragments": self.dropped_fragments
+            }
+
+    # Get the sequence numbers of the fragments missing from a message, the ones
+    # before the last fragment received, that weren't reported (NACK) yet, nor can
+    # be rebuilt from the parity of their group (FEC)
+    def get_missing_packets(self, client, msg_id):
+        session = self.sessions.get(client)
+        if session is None:
+            return []
+        with session.lock:
+            return session.packets_to_reorder.missing(msg_id, MAX_NACK_SEQ_NUMBERS,
+                                                      session.fec_group_size)
 
-            # Fragmentation/reordering is possible
+    ###
+    # Sequence numbers of packets received
+    ###
 
-            # save the packets to remove from the list of packets to reorder
-            buffered_packets = packets.copy()
+    # Add the sequence number of a received packet, return False if the
+    # packet was already received (duplicated) or the agent isn't connected
+    def add_packet_received(self, client, seq_number):
+        session = self.sessions.get(client)
+        if session is None:
+            return False
+        with session.lock:
+            return session.receive_state.add(seq_number)
+
+    # Check if a received packet is within the window of sequence numbers tracked,
+    # the packets ahead of it are discarded without an ACK
+    def is_packet_in_window(self, client, seq_number):
+        session = self.sessions.get(client)
+        if session is None:
+            return False
+        with session.lock:
+            return session.receive_state.in_window(seq_number)
 
-            # reorder packets by sequence number
-            # note: duplicated packets were already removed before calling this method
-            packets = sorted(packets, key=lambda x: x["seq_number"])
+    ###
+    # Cumulative and selective ACKs
+    ###
 
-            # defragment data by concatenating the data of all packets
-            packet = packets[0]
-            for i in range(1, len(packets)):
-                packet["data"] += packets[i]["data"]
+    # Get the ACK block to send to the agent, None if the agent isn't connected,
+    # as the packets it sent before are unknown (the ACK only acknowledges its own
+    # sequence number)
+    def get_ack_block(self, client):
+        session = self.sessions.get(client)
+        if session is None:
+            return None
+        with session.lock:
+            return session.receive_state.ack_block()
+
+    # Check if the ACK of a received packet can be delayed, only new packets
+    # received in order, neither urgent nor retransmitted, are acknowledged later,
+    # unless the window is closed, as the agent waits for the ACKs to send more
+    def can_delay_ack(self, client, packet):
+        session = self.sessions.get(client)
+        if C.NET_TASK_VERSION not in SACK_VERSIONS or session is None:
+            return False
+        with session.lock:
+            return (packet.urgent == 0 and packet.retransmission == 0
+                    and session.receive_state.is_in_order()
+                    and len(session.packets_to_reorder) < C.AGENT_WINDOW_SIZE)
 
-            # remove the defragmented packets from the list of packets to reorder
-            self.packets_to_reorder[client] = [
-                f_packet for f_packet in self.packets_to_reorder[client]
-                if f_packet not in buffered_packets
-            ]
+    ###
+    # Server window size
+    ###
 
-            # update the window size
-            self.server_window_size += len(buffered_packets)
+    # Window size advertised to an agent, the space left for the agent in the server
+    # buffer (credits), capped by the space left in the buffer shared by all the agents.
+    # An agent with partial messages buffered is throttled without affecting the others
+    def get_server_window_size(self, client):
+        session = self.sessions.get(client)
+        if session is None:
+            window_size = C.AGENT_WINDOW_SIZE
+        else:
+            with session.lock:
+                window_size = C.AGENT_WINDOW_SIZE - len(session.packets_to_reorder)
 
-            return packet  # packet with defragmented data
+        with self.lock:
+            return min(window_size, self.server_window_size)
 
     ###
-    # Sequence numbers of packets received
+    # Agents round-trip time and retransmission timeout
     ###
 
-    def add_packet_received(self, client, seq_number):
-        with self.lock:
-            if client not in self.packets_received:
-                self.packets_received[client] = []
-            self.packets_received[client].append(seq_number)
+    def get_rto(self, client):
+        session = self.sessions.get(client)
+        if session is None:
+            return C.INITIAL_RTO
+        with session.lock:
+            return session.rtt_estimator.rto
 
-    def is_packet_received(self, client, seq_number):
-        with self.lock:
-            if client not in self.packets_received:
-                return False
-            return seq_number in self.packets_received[client]
+    def backoff_rto(self, client, expired_rto):
+        session = self.sessions.get(client)
+        if session is None:
+            return
+        with session.lock:
+            session.rtt_estimator.backoff(expired_rto)
 
     ###
-    # Server window size
+    # Agents congestion windows
     ###
 
-    def get_server_window_size(self):
-        with self.lock:
-            return self.server_window_size
+    # Shrink the congestion window of an agent after a loss reported by a NACK
+    def reduce_congestion_window(self, client):
+        session = self.sessions.get(client)
+        if session is None:
+            return
+
+        now = time.monotonic()
+        with session.lock:
+            session.congestion.on_loss(now, session.rtt_estimator.rto, False)
+            session.update_pacing_rate(now)
+
+    # Handle the retransmission timeout of a packet, return None if it was acknowledged
+    # meanwhile, True if it can be retransmitted, or False if it waits for the congestion
+    # window. The window collapses on a timeout, and only the oldest packets in flight
+    # that fit in it are retransmitted, the others wait for the window to grow with the
+    # next ACKs. The timeouts of the packets waiting for the window aren't new losses
+    def expire_packet_to_ack(self, client, packet):
+        session = self.sessions.get(client)
+        if session is None:
+            return None
+
+        now = time.monotonic()
+        with session.lock:
+            if session.packets_to_ack.get(packet.seq_number) is not packet:
+                return None
+
+            if packet.seq_number not in session.packets_to_retransmit:
+                session.congestion.on_loss(now, session.rtt_estimator.rto, True)
+                session.update_pacing_rate(now)
+
+            if packet.urgent == 0:
+                for index, seq_number in enumerate(session.packets_to_ack):
+                    if index >= session.congestion.window:
+                        session.packets_to_retransmit[packet.seq_number] = packet
+                        return False
+                    if seq_number == packet.seq_number:
+                        break
+
+            session.packets_to_retransmit.pop(packet.seq_number, None)
+            return True
 
     ###
     # Agents window sizes
     ###
 
     def get_client_window_size(self, client):
-        with self.lock:
-            try:
-                return self.agents_window_sizes[client]
-            except KeyError:
-                return 1
+        session = self.sessions.get(client)
+        if session is None:
+            return 1
+        return session.window_size
 
     def set_client_window_size(self, client, window_size):
-        with self.lock:
-            try:
-                self.agents_window_sizes[client] = window_size
-            except KeyError:
-                pass
+        session = self.sessions.get(client)
+        if session is None:
+            return
+
+        with session.lock:
+            session.window_size = window_size
+
+    ###
+    # Agents forward error correction
+    ###
+
+    # Number of fragments per parity group (FEC) of the messages
+    # exchanged with an agent, 0 if disabled
+    def get_client_fec_group_size(self, client):
+        session = self.sessions.get(client)
+        return session.fec_group_size if session is not None else 0
+
+    # Set the group size proposed by the agent on the first connection
+    def set_client_fec_group_size(self, client, fec_group_size):
+        session = self.sessions.get(client)
+        if session is None:
+            return
+        with session.lock:
+            session.fec_group_size = negotiate_group_size(fec_group_size)
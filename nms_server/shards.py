@@ -0,0 +1,269 @@
+import multiprocessing
+import multiprocessing.connection
+import queue
+import signal
+import sys
+import threading
+import time
+
+import constants as C
+
+from .pool import Pool
+from .task import Task
+from .udp  import UDP, bind_socket
+from .aio  import AsyncUDP
+
+
+# Multi-process NetTask server.
+# Each process (shard) runs its own NetTask server, with its own pool of agents,
+# bound to the same UDP port with SO_REUSEPORT. The kernel dispatches the datagrams
+# by a hash of the agent address, so all the packets of an agent reach the same
+# shard, and the agents are partitioned among the shards without any shared state.
+# The hash depends on the sockets bound to the port, so they're all bound by the
+# parent process before the shards start, and kept open until the server shuts down.
+# A shard that exits is restarted on the same socket, and adopts its agents. Each
+# shard has its own pipes to the parent, so a shard that dies doesn't hold a lock
+# shared with the other shards.
+# The status and metrics are sent to the parent process, which stores them, as well
+# as the state of the agents of each shard, shown by the UI of the parent, and the
+# parent signals the shards to send the end of connection to their agents and exit.
+
+# Time to wait for a shard to exit, after the end of connection timeout
+SHARD_EXIT_TIMEOUT = 5  # seconds
+
+# Time between the statistics updates sent by the shards, the agents shown by the UI
+# of the parent process are as recent as the last update
+SHARD_STATS_INTERVAL = 1  # seconds
+
+
+# UI of a shard, forwards the events to the UI of the parent process through the
+# pipe of the shard, sent by a thread so the server threads never wait for the parent
+class ShardUI:
+    def __init__(self, server_hostname, events):
+        self.server_hostname = server_hostname
+        self.events = events
+        self.view_mode = False  # The packets are only displayed by the threaded server
+        self.queue = queue.SimpleQueue()
+        self.sender = threading.Thread(target=self.send_events, daemon=True)
+        self.sender.start()
+
+    def send_events(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            try:
+                self.events.send(event)
+            except OSError:
+                break  # the parent process exited
+
+    def put(self, method, *args):
+        self.queue.put((method, args))
+
+    def save_status(self, message):
+        self.put("save_status", message)
+
+    def save_metrics(self, hostname, metrics):
+        self.put("save_metrics", hostname, metrics)
+
+    def display_error(self, message):
+        self.put("display_error", str(message))
+
+    def display_warning(self, message):
+        self.put("display_warning", str(message))
+
+    # Send the events left and close the pipe
+    def close(self):
+        self.queue.put(None)
+        self.sender.join()
+        self.events.close()
+
+
+# Entry point of a shard process, the shard runs until the parent closes its stop pipe
+def run_shard(index, server_hostname, config, events, stop, verbose, engine, workers,
+              server_socket, adopt_clients):
+    # The parent process handles the interrupts and stops the shards
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    ui = ShardUI(server_hostname, events)
+    pool = Pool()
+    task_server = Task(config)
+
+    if engine == "asyncio":
+        udp_server = AsyncUDP(ui, pool, task_server, None, verbose=verbose,
+                              server_socket=server_socket, adopt_clients=adopt_clients)
+    else:
+        udp_server = UDP(ui, pool, task_server, verbose=verbose, workers=workers,
+                         server_socket=server_socket, adopt_clients=adopt_clients)
+    udp_server.start()
+
+    while not stop.poll(SHARD_STATS_INTERVAL):
+        queued, dropped = udp_server.get_handler_stats()
+        ui.put("update_stats", index, queued, dropped,
+               udp_server.get_clients_stats(), udp_server.get_reassembly_stats())
+
+    # Send EOC to the agents of the shard and await until they send the ACK,
+    # the agents that don't respond are dropped after the EOC timeout, and
+    # the wait is bounded for the agents connected after the EOC was sent
+    udp_server.send_end_of_connection()
+    start_time = time.monotonic()
+    while (not pool.wait_packets_to_ack(timeout=1)
+           and time.monotonic() - start_time < C.EOC_ACK_TIMEOUT):
+        pass
+
+    udp_server.shutdown()
+    udp_server.join()
+    ui.close()
+
+
+class Shards:
+    def __init__(self, ui, config, nr_shards, verbose=False, engine="threads",
+                 workers=C.UDP_WORKERS):
+        self.ui = ui
+        self.config = config
+        self.verbose = verbose
+        self.engine = engine
+        self.workers = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = [None] * nr_shards
+        self.events = dict()      # Pipe of the events sent by each shard, by shard
+        self.stops = dict()       # Pipe closed to stop each shard, by shard
+        self.stopping = False     # Set once the shards are stopped, not to restart them
+        self.stats = dict()       # Packets queued to be handled and dropped, by shard
+        self.clients = dict()     # State of the connected agents, by shard
+        self.reassembly = dict()  # Reassembly stats, by shard
+        self.lock = threading.Lock()
+
+        try:
+            self.sockets = [bind_socket('0.0.0.0', C.UDP_PORT, reuse_port=True)
+                            for _ in range(nr_shards)]
+        except OSError:
+            ui.display_error(f"UDP port {C.UDP_PORT} is already in use. Exiting.")
+            sys.exit(1)
+
+        self.events_thread = threading.Thread(target=self.handle_events, daemon=True)
+
+    # Start a shard on its socket, the parent keeps only its ends of the pipes,
+    # so the pipe of the events is closed once the shard exits (the lock must be held)
+    def start_shard(self, index, adopt_clients=False):
+        events_reader, events_writer = self.context.Pipe(duplex=False)
+        stop_reader, stop_writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=run_shard, name=f"nms-shard-{index}",
+                                       args=(index, self.ui.server_hostname, self.config,
+                                             events_writer, stop_reader, self.verbose,
+                                             self.engine, self.workers, self.sockets[index],
+                                             adopt_clients))
+        process.start()
+        events_writer.close()
+        stop_reader.close()
+
+        self.processes[index] = process
+        self.events[index] = events_reader
+        self.stops[index] = stop_writer
+
+    def start(self):
+        with self.lock:
+            for index in range(len(self.processes)):
+                self.start_shard(index)
+        self.events_thread.start()
+        self.ui.save_status(f"UDP Server started on port {C.UDP_PORT} "
+                            f"with {len(self.processes)} processes")
+
+    # Handle the events of the shards, until all the shards exit after the shutdown
+    def handle_events(self):
+        while True:
+            with self.lock:
+                readers = {events: index for index, events in self.events.items()}
+            if not readers:
+                break
+
+            for events in multiprocessing.connection.wait(list(readers), SHARD_STATS_INTERVAL):
+                index = readers[events]
+                try:
+                    method, args = events.recv()
+                except (EOFError, OSError):
+                    self.restart_shard(index)
+                    continue
+
+                if method == "update_stats":
+                    index, queued, dropped, clients, reassembly = args
+                    with self.lock:
+                        self.stats[index] = (queued, dropped)
+                        self.clients[index] = clients
+                        self.reassembly[index] = reassembly
+                else:
+                    getattr(self.ui, method)(*args)
+
+    # Restart a shard that exited (closed its pipe) before the server shutdown, on the
+    # socket of the shard replaced, so the agents are still dispatched to it, and the
+    # new shard adopts them as they send
+    def restart_shard(self, index):
+        with self.lock:
+            self.events.pop(index).close()
+            self.stats.pop(index, None)
+            self.clients.pop(index, None)
+            self.reassembly.pop(index, None)
+            if self.stopping:
+                return
+            process = self.processes[index]
+
+        process.join(SHARD_EXIT_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+        with self.lock:
+            if self.stopping:
+                return
+            self.ui.display_warning(f"Shard {process.name} exited with code "
+                                    f"{process.exitcode}. Restarting.")
+            self.stops.pop(index).close()
+            self.start_shard(index, adopt_clients=True)
+
+    def get_handler_stats(self):
+        with self.lock:
+            return (sum(queued for queued, _ in self.stats.values()),
+                    sum(dropped for _, dropped in self.stats.values()))
+
+    # State of the connected agents of all the shards, by agent
+    def get_clients_stats(self):
+        with self.lock:
+            return {client: stats
+                    for clients in self.clients.values()
+                    for client, stats in clients.items()}
+
+    # Reassembly stats summed over the shards
+    def get_reassembly_stats(self):
+        stats = {"buffered_bytes": 0, "evicted_messages": 0,
+                 "evicted_fragments": 0, "dropped_fragments": 0}
+        with self.lock:
+            for reassembly in self.reassembly.values():
+                for key in stats:
+                    stats[key] += reassembly[key]
+        return stats
+
+    # Signal the shards to send the EOC to their agents and exit, by closing their
+    # stop pipes, return the shards stopped
+    def stop_shards(self):
+        with self.lock:
+            self.stopping = True
+            for stop in self.stops.values():
+                stop.close()
+            return list(self.processes)
+
+    def send_end_of_connection(self):
+        self.stop_shards()
+
+    def shutdown(self):
+        for process in self.stop_shards():
+            process.join(C.EOC_ACK_TIMEOUT + SHARD_EXIT_TIMEOUT)
+            if process.is_alive():
+                self.ui.display_warning(f"Shard {process.name} didn't exit. Terminating.")
+                process.terminate()
+                process.join()
+
+        for server_socket in self.sockets:
+            server_socket.close()
+
+    def join(self):
+        self.events_thread.join()
@@ -65,60 +65,65 @@ class TCP(threading.Thread):
                     if not raw_data:
                         break
 
-                    try:
-                        packet = self.alert_flow.parse_packet(self.alert_flow, raw_data)
-                        if self.ui.view_mode and self.verbose:
-                            print(f"Received alert {packet}")
-                    except (InvalidVersionException, InvalidHeaderException) as e:
-                        self.ui.display_error(e)
+                    if not self.handle_alerts(raw_data):
                         break
-
-                    # Save alerts received
-                    agent_id = packet['identifier']
-                    alerts = json.loads(packet['data'])
-
-                    for alert_type, alert_data in alerts.items():
-                        alert_type = int(alert_type)
-                        messages = []
-                        match alert_type:
-                            case AlertFlow.CPU_USAGE:
-                                messages.append(
-                                    f"CPU usage {alert_data['cpu_usage']}. " +
-                                    f"Alert condition: {alert_data['alert_condition']}"
-                                )
-                            case AlertFlow.RAM_USAGE:
-                                messages.append(
-                                    f"RAM usage {alert_data['ram_usage']}. " +
-                                    f"Alert condition: {alert_data['alert_condition']}"
-                                )
-                            case AlertFlow.INTERFACE_STATS:
-                                for interface in alert_data:
-                                    messages.append(
-                                        f"Interface {interface['interface']} " +
-                                        f"received {interface['interface_stats']} packets. " +
-                                        f"Alert condition: {interface['alert_condition']}"
-                                    )
-                            case AlertFlow.PACKET_LOSS:
-                                messages.append(
-                                    f"Packet loss {alert_data['packet_loss']}. " +
-                                    f"Alert condition: {alert_data['alert_condition']}"
-                                )
-                            case AlertFlow.JITTER:
-                                messages.append(
-                                    f"Jitter {alert_data['jitter']}. " +
-                                    f"Alert condition: {alert_data['alert_condition']}"
-                                )
-                            case _:
-                                if self.ui.view_mode:
-                                    print("Unknown alert type received")
-
-                        for message in messages:
-                            self.ui.save_alert(agent_id, alert_type, message)
-
-                        messages = []
                 except socket.timeout:
                     pass
 
+    # Save the alerts of an AlertFlow packet, return False if the packet is invalid
+    def handle_alerts(self, raw_data):
+        try:
+            packet = self.alert_flow.parse_packet(self.alert_flow, raw_data)
+            if self.ui.view_mode and self.verbose:
+                print(f"Received alert {packet}")
+        except (InvalidVersionException, InvalidHeaderException) as e:
+            self.ui.display_error(e)
+            return False
+
+        # Save alerts received
+        agent_id = packet['identifier']
+        alerts = json.loads(packet['data'])
+
+        for alert_type, alert_data in alerts.items():
+            alert_type = int(alert_type)
+            messages = []
+            match alert_type:
+                case AlertFlow.CPU_USAGE:
+                    messages.append(
+                        f"CPU usage {alert_data['cpu_usage']}. " +
+                        f"Alert condition: {alert_data['alert_condition']}"
+                    )
+                case AlertFlow.RAM_USAGE:
+                    messages.append(
+                        f"RAM usage {alert_data['ram_usage']}. " +
+                        f"Alert condition: {alert_data['alert_condition']}"
+                    )
+                case AlertFlow.INTERFACE_STATS:
+                    for interface in alert_data:
+                        messages.append(
+                            f"Interface {interface['interface']} " +
+                            f"received {interface['interface_stats']} packets. " +
+                            f"Alert condition: {interface['alert_condition']}"
+                        )
+                case AlertFlow.PACKET_LOSS:
+                    messages.append(
+                        f"Packet loss {alert_data['packet_loss']}. " +
+                        f"Alert condition: {alert_data['alert_condition']}"
+                    )
+                case AlertFlow.JITTER:
+                    messages.append(
+                        f"Jitter {alert_data['jitter']}. " +
+                        f"Alert condition: {alert_data['alert_condition']}"
+                    )
+                case _:
+                    if self.ui.view_mode:
+                        print("Unknown alert type received")
+
+            for message in messages:
+                self.ui.save_alert(agent_id, alert_type, message)
+
+        return True
+
     def shutdown(self):
         # Signal all threads to stop
         self.shutdown_flag.set()
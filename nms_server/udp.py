@@ -6,7 +6,10 @@ import json
 
 import constants as C
 
-from protocol.net_task import NetTask
+from protocol.congestion import TokenBucket
+from protocol.net_task   import NetTask, pad_identifier, peek_identifier
+from protocol.timer      import TimerService
+from protocol.workers    import WorkerPool
 
 # NetTask exceptions
 from protocol.exceptions.invalid_version   import InvalidVersionException
@@ -14,15 +17,35 @@ from protocol.exceptions.invalid_header    import InvalidHeaderException
 from protocol.exceptions.checksum_mismatch import ChecksumMismatchException
 
 
+# Create the UDP socket of a NetTask server bound to a port, that can be shared
+# with the other server processes (Linux only), the kernel dispatches the datagrams
+# by the agent address among the sockets bound to the port
+def bind_socket(host, port, reuse_port=False):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Disable checksum check for UDP (Linux only)
+        server_socket.setsockopt(socket.SOL_SOCKET, C.SO_NO_CHECK, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+    except OSError:
+        server_socket.close()
+        raise
+    return server_socket
+
+
 class UDP(threading.Thread):
-    def __init__(self, ui, pool, task_server, verbose=False, host='0.0.0.0'):
+    # A server given a socket bound by another process serves the agents that the
+    # kernel dispatches to it, and adopts the agents it doesn't know when it replaces
+    # the server of another process
+    def __init__(self, ui, pool, task_server, verbose=False, host='0.0.0.0',
+                 workers=C.UDP_WORKERS, server_socket=None, adopt_clients=False):
         super().__init__(daemon=True)
         self.ui = ui
         self.host = host
         self.port = C.UDP_PORT
         self.server_hostname = ui.server_hostname
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_socket.settimeout(1.0)
+        self.adopt_clients = adopt_clients
         self.shutdown_flag = threading.Event()
         self.net_task = NetTask()
         self.pool = pool
@@ -32,85 +55,190 @@ class UDP(threading.Thread):
         self.verbose = verbose
 
         # Start the UDP server
-        try:
-            # Disable checksum check for UDP (Linux only)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, C.SO_NO_CHECK, 1)
-            self.server_socket.bind((self.host, self.port))
-        except OSError:
-            self.ui.display_error(f"UDP port {self.port} is already in use. Exiting.")
-            sys.exit(1)
+        if server_socket is None:
+            try:
+                server_socket = bind_socket(self.host, self.port)
+            except OSError:
+                self.ui.display_error(f"UDP port {self.port} is already in use. Exiting.")
+                sys.exit(1)
+        self.server_socket = server_socket
+        self.server_socket.settimeout(1.0)
         self.ui.save_status(f"UDP Server started on port {self.port}")
 
-        # Initialize the retransmit thread
-        ret_thread = threading.Thread(target=self.retransmit_packets)
-        self.threads.append(ret_thread)
-        ret_thread.start()
+        # Initialize the timer service, for retransmissions, window probes and EOC timeouts
+        self.timers = self.create_timers()
+
+        # Initialize the workers handling the datagrams received
+        self.workers = self.create_workers(workers)
+
+        # Window probe timers of the agents with a window size of 0
+        self.window_probes = dict()
+
+        # Delayed ACK timers of the agents with packets yet to be acknowledged
+        self.delayed_acks = dict()
+
+        # Pacing timers of the agents with packets queued waiting for the pacing
+        self.pacing_timers = dict()
+
+        # Evict the stale partial messages periodically
+        self.timers.schedule(C.REASSEMBLY_TTL / 2, self.eviction_timeout)
+
+    def create_timers(self):
+        timers = TimerService()
+        self.threads.append(timers)
+        timers.start()
+        return timers
 
-        # Initialize the window size control thread
-        win_thread = threading.Thread(target=self.window_size_control)
-        self.threads.append(win_thread)
-        win_thread.start()
+    def create_workers(self, workers):
+        pool = WorkerPool(workers, C.UDP_QUEUE_SIZE, name="udp-server")
+        pool.start()
+        return pool
+
+    # Send a datagram, given as a list of buffers, to an agent
+    def send_datagram(self, buffers, addr):
+        with self.lock:
+            self.server_socket.sendmsg(buffers, [], 0, addr)
 
     # NOTE retransmission of packets does not increment the sequence number
-    def retransmit_packets(self):
-        while not self.shutdown_flag.is_set():
-            # Sleep for a while before retransmitting the packets
-            time.sleep(C.RETRANSMIT_SLEEP_TIME)
-            if self.shutdown_flag.is_set():
-                break
+    # Packets are retransmitted as they were first sent, with the original sequence
+    # number, when their own retransmission timer expires
+    def retransmit_timeout(self, agent_id, packet):
+        addr = self.pool.get_client_address(agent_id)
+        if addr is None:
+            return
 
-            # Get the connected agents and respective addresses
-            agents = self.pool.get_connected_clients()
-
-            # For each agent, get the packets to retransmit and retransmit them
-            for agent_id in agents:
-                addr = agents[agent_id]
-                packets = self.pool.get_packets_to_ack(agent_id)
-                for packet in packets:
-                    # build the packet to be retransmitted and set the retransmission flag
-                    seq_number = self.pool.get_seq_number(agent_id)
-                    window_size = self.pool.get_server_window_size()
-                    flags = packet["flags"]
-                    flags["retransmission"] = 1
-                    _, ret_packets = self.net_task.build_packet(
-                        self.net_task, packet["data"],
-                        seq_number, flags,
-                        packet["msg_type"], agent_id,
-                        window_size)
-
-                    # wait if the server window size is 0 and the URG flag is not set
-                    urgent = flags.get("urgent", 0)
-                    if urgent == 0:
-                        while self.pool.get_client_window_size(agent_id) <= 0:
-                            time.sleep(1)
-
-                    for ret_packet in ret_packets:
-                        with self.lock:
-                            self.server_socket.sendto(ret_packet, addr)
-
-                        if self.verbose and self.ui.view_mode:
-                            print(f"Retransmitting packet: {json.dumps(packet, indent=2)}")
-
-    def window_size_control(self):
-        while not self.shutdown_flag.is_set():
-            # Sleep for a while before retransmitting the packets
-            time.sleep(C.WINDOW_PROBE_SLEEP_TIME)
-            if self.shutdown_flag.is_set():
-                break
+        # the congestion window collapses, and only the oldest packets in flight that
+        # fit in it are retransmitted, the others are retransmitted as the ACKs grow
+        # the window (their timers are restarted in case no ACK arrives), so a
+        # timeout of a whole window doesn't retransmit it in a single burst.
+        # The packets in flight were already admitted by the agent window size,
+        # so they're retransmitted even if the window is closed meanwhile.
+        # The packet can be acknowledged after its timer expired, while it runs
+        retransmit = self.pool.expire_packet_to_ack(agent_id, packet)
+        if retransmit is None:
+            return
+        if not retransmit:
+            self.start_retransmit_timer(agent_id, packet, self.pool.get_rto(agent_id))
+            return
 
-            # Get the connected agents and respective addresses
-            agents = self.pool.get_connected_clients()
+        # the retransmission timeout of the agent is doubled from the expired timeout
+        self.pool.backoff_rto(agent_id, packet.rto)
+        rto = self.pool.get_rto(agent_id)
 
-            # For each agent, if his window size is 0, send a window probe
-            for agent_id in agents:
-                addr = agents[agent_id]
-                window_size = self.pool.get_client_window_size(agent_id)
-                if window_size <= 0:
-                    self.send("", {"urgent": 1, "window_probe": 1},
-                              self.net_task.UNDEFINED, agent_id, addr)
+        self.retransmit(agent_id, packet, addr, rto)
 
-                    if self.verbose and self.ui.view_mode:
-                        print(f"Sending window probe to {agent_id}")
+    # Retransmit the packets reported as missing (NACK) by an agent right away,
+    # without waiting for their retransmission timers nor backing off the timeout,
+    # the congestion window is halved, as the losses are a sign of congestion
+    def fast_retransmit(self, agent_id, seq_numbers):
+        addr = self.pool.get_client_address(agent_id)
+        if addr is None:
+            return
+
+        self.pool.reduce_congestion_window(agent_id)
+
+        rto = self.pool.get_rto(agent_id)
+        for seq_number in seq_numbers:
+            packet = self.pool.get_packet_to_ack(agent_id, seq_number)
+            if packet is None:
+                continue  # already acknowledged
+            packet.cancel_timer()
+            self.retransmit(agent_id, packet, addr, rto)
+
+    def retransmit(self, agent_id, packet, addr, rto):
+        # restart the retransmission timer and set the retransmission flag,
+        # unless the packet was acknowledged meanwhile
+        if not self.start_retransmit_timer(agent_id, packet, rto):
+            return
+        packet.set_retransmission_flag()
+
+        self.send_datagram(packet.buffers, addr)
+
+        if self.verbose and self.ui.view_mode:
+            print(f"Retransmitting packet: {json.dumps(packet.to_dict(), indent=2)}")
+
+    # Start the retransmission timer of a packet, return False if it was acknowledged
+    def start_retransmit_timer(self, agent_id, packet, rto):
+        return self.pool.set_retransmit_timer(
+            agent_id, packet, rto,
+            lambda rto: self.timers.schedule(rto, self.retransmit_timeout, agent_id, packet))
+
+    # Delay the ACK of a packet, the ACK is sent when the timer expires, unless
+    # it's piggybacked on a data packet sent to the agent meanwhile. The ACK block
+    # sent acknowledges all the packets received from the agent until then
+    def start_delayed_ack(self, packet, agent_id, addr):
+        with self.lock:
+            if agent_id not in self.delayed_acks:
+                self.delayed_acks[agent_id] = self.timers.schedule(
+                    C.DELAYED_ACK_TIMEOUT, self.delayed_ack_timeout, packet, agent_id, addr)
+
+    def delayed_ack_timeout(self, packet, agent_id, addr):
+        if self.cancel_delayed_ack(agent_id):
+            self.send_ack(packet, agent_id, addr)
+
+    # Cancel the delayed ACK of an agent, return False if there was none pending
+    def cancel_delayed_ack(self, agent_id):
+        with self.lock:
+            timer = self.delayed_acks.pop(agent_id, None)
+        if timer is None:
+            return False
+        timer.cancel()
+        return True
+
+    # Probe the window size of an agent periodically, while it's 0 or less
+    def start_window_probe(self, agent_id):
+        with self.lock:
+            if agent_id not in self.window_probes:
+                self.window_probes[agent_id] = self.timers.schedule(
+                    C.WINDOW_PROBE_SLEEP_TIME, self.window_probe_timeout, agent_id)
+
+    def window_probe_timeout(self, agent_id):
+        with self.lock:
+            self.window_probes.pop(agent_id, None)
+
+        addr = self.pool.get_client_address(agent_id)
+        if addr is None or self.pool.get_client_window_size(agent_id) > 0:
+            return
+
+        self.send("", {"urgent": 1, "window_probe": 1},
+                  self.net_task.UNDEFINED, agent_id, addr)
+
+        if self.verbose and self.ui.view_mode:
+            print(f"Sending window probe to {agent_id}")
+
+        self.start_window_probe(agent_id)
+
+    # Evict the partial messages without fragments received for too long,
+    # restoring the server window size taken by their fragments
+    def eviction_timeout(self):
+        evicted = self.pool.evict_stale_messages()
+        if evicted and self.verbose and self.ui.view_mode:
+            print(f"Evicted {evicted} partial messages")
+
+        self.timers.schedule(C.REASSEMBLY_TTL / 2, self.eviction_timeout)
+
+    # Drop an agent that didn't acknowledge the end of connection in time
+    def eoc_timeout(self, agent_id):
+        if self.pool.is_client_connected(agent_id):
+            self.pool.remove_client(agent_id)
+            self.ui.save_status(f"Agent {agent_id} didn't acknowledge the end of connection.")
+
+    # Window size advertised to an agent, the buffer space left for the agent less
+    # the packets received still queued in its lane, not the ones of the other agents
+    def get_window_size(self, agent_id):
+        return (self.pool.get_server_window_size(agent_id)
+                - self.workers.get_depth(pad_identifier(agent_id)))
+
+    # Number of packets queued to be handled, and dropped with the queues full
+    def get_handler_stats(self):
+        return len(self.workers), self.workers.get_dropped()
+
+    # State of the connected agents, by agent
+    def get_clients_stats(self):
+        return self.pool.get_clients_stats()
+
+    def get_reassembly_stats(self):
+        return self.pool.get_reassembly_stats()
 
     def run(self):
         while not self.shutdown_flag.is_set():
@@ -119,13 +247,13 @@ class UDP(threading.Thread):
                 if not raw_data:
                     break
 
-                # Create a thread to handle the packet
-                handle_packet_thread = threading.Thread(target=self.handle_packet,
-                                                        args=(raw_data, addr,))
-                self.threads.append(handle_packet_thread)
-                handle_packet_thread.start()
-                # INFO To process the packets sequentially, join the thread
-                # handle_packet_thread.join()
+                # Queue the packet to be handled by the worker of the agent lane, after
+                # the packets received before from the same agent, it's dropped if the
+                # lane is full and retransmitted later, as it isn't acknowledged
+                if not self.workers.submit(peek_identifier(raw_data), self.handle_packet,
+                                           raw_data, addr):
+                    if self.verbose and self.ui.view_mode:
+                        print("Handler lane full, dropping packet")
             except socket.timeout:
                 continue
             except OSError:
@@ -145,48 +273,95 @@ class UDP(threading.Thread):
             return
 
         if self.verbose and self.ui.view_mode:
-            print(f"Received packet: {json.dumps(packet, indent=2)}")
+            print(f"Received packet: {json.dumps(packet.to_dict(), indent=2)}")
 
-        agent_id = packet["identifier"]
+        agent_id = packet.identifier
 
         # Save the received agent window size
-        self.pool.set_client_window_size(agent_id, packet["window_size"])
+        self.pool.set_client_window_size(agent_id, packet.window_size)
+        if packet.window_size <= 0:
+            self.start_window_probe(agent_id)
+
+        # If the packet received is a NACK, retransmit the packets listed as missing
+        # by the agent. NACKs aren't acknowledged, so we interrupt this function.
+        if packet.msg_type == self.net_task.NACK:
+            self.fast_retransmit(agent_id, packet.nack_seq_numbers)
+            return
 
         # If the packet received is a ACK, process the previous packet sent
         # as acknowledged and remove it from the list of packets to be "acked",
-        # for that specific agent. After that we interrupt this function.
-        if packet["flags"]["ack"] == 1:
-            self.pool.remove_packet_to_ack(agent_id, packet["seq_number"])
+        # for that specific agent, along with the packets covered by its ACK block.
+        # After that we interrupt this function, unless the ACK is piggybacked
+        # on a data packet, which is processed as any other packet.
+        # The packets queued are sent as the acknowledged packets leave the window.
+        if packet.ack == 1:
+            if not packet.piggybacked:
+                self.pool.remove_packet_to_ack(agent_id, packet.seq_number, packet.ack_block)
+                self.send_packets(agent_id, addr)
+                return
+            self.pool.remove_packet_to_ack(agent_id, None, packet.ack_block)
+            self.send_packets(agent_id, addr)
+
+        # Handle first connection by adding the client to the pool, a retransmitted
+        # first connection of a connected agent must not reset its session
+        if packet.msg_type == self.net_task.FIRST_CONNECTION:
+            if packet.retransmission == 0 or not self.pool.is_client_connected(agent_id):
+                self.pool.add_client(agent_id, addr, packet.seq_number)
+
+        # Discard the packets of agents not connected, without keeping any state,
+        # the EOC is acknowledged so the agent doesn't wait for it. The agents of a
+        # server replaced are adopted from the first packet received, with the next
+        # sequence number they expect, if they piggybacked an ACK block
+        elif not self.pool.is_client_connected(agent_id):
+            if packet.msg_type == self.net_task.EOC:
+                self.send_ack(packet, agent_id, addr)
+                return
+            if not self.adopt_clients:
+                return
+            self.pool.add_client(agent_id, addr, packet.seq_number)
+            if packet.piggybacked:
+                self.pool.set_seq_number(agent_id, packet.ack_block[0])
+
+        # discard the packets ahead of the window of sequence numbers tracked, or
+        # over the reassembly budgets, without an ACK, so the agent retransmits them later
+        if not self.pool.is_packet_in_window(agent_id, packet.seq_number):
             return
-
-        # Handle first connection by adding the client to the pool
-        if packet["msg_type"] == self.net_task.FIRST_CONNECTION:
-            self.pool.add_client(agent_id, addr)
-
-        # send ACK
-        window_size = self.pool.get_server_window_size()
-        ack_packet = self.net_task.build_ack_packet(packet, agent_id, window_size)
-
-        with self.lock:
-            self.server_socket.sendto(ack_packet, addr)
-
-        if self.verbose and self.ui.view_mode:
-            print(f"Sending ACK for packet {packet['seq_number']} to {agent_id}")
-
-        # whenever the server receives a duplicated packet,
-        # the ack is sent, but the packet is discarded
-        if self.pool.is_packet_received(agent_id, packet["seq_number"]):
+        if not self.pool.has_buffer_space(agent_id, packet):
+            if self.verbose and self.ui.view_mode:
+                print(f"Reassembly buffer full for {agent_id}, discarding packet")
             return
 
-        # add the sequence number to the list of received packets
-        self.pool.add_packet_received(agent_id, packet["seq_number"])
-
-        # increment the sequence number
-        self.pool.inc_seq_number(agent_id)
-
-        # Packet reordering and defragmentation
-        packet = self.pool.reorder_packets(agent_id, packet)
+        # parity packets (FEC) don't take a sequence number and aren't acknowledged
+        if not packet.parity:
+            # add the sequence number to the list of received packets,
+            # before sending the ACK so its ACK block covers this packet
+            duplicated = not self.pool.add_packet_received(agent_id, packet.seq_number)
+
+            # send ACK, unless it can be delayed to be coalesced or piggybacked
+            if duplicated or not self.pool.can_delay_ack(agent_id, packet):
+                self.send_ack(packet, agent_id, addr)
+            else:
+                self.start_delayed_ack(packet, agent_id, addr)
+
+            # whenever the server receives a duplicated packet,
+            # the ack is sent, but the packet is discarded
+            if duplicated:
+                return
+
+        # Packet reordering and defragmentation, a fragment rebuilt from the parity
+        # of its group is acknowledged as received, so the agent doesn't retransmit it
+        msg_id = packet.msg_id
+        packet, recovered = self.pool.reorder_packets(agent_id, packet)
+        for fragment in recovered:
+            self.send_ack(fragment, agent_id, addr)
+            if self.verbose and self.ui.view_mode:
+                print(f"Recovered packet {fragment.seq_number} from {agent_id} (FEC)")
         if packet is None:
+            # report the fragments missing before the ones received (NACK),
+            # so the agent retransmits them without waiting for their timers
+            missing = self.pool.get_missing_packets(agent_id, msg_id)
+            if missing:
+                self.send_nack(missing, msg_id, agent_id, addr)
             if self.verbose and self.ui.view_mode:
                 print(f"Adding packet to defrag/reorder array for {agent_id}")
             return  # wait for the missing packets
@@ -197,19 +372,20 @@ class UDP(threading.Thread):
         # - End of connection: remove the client from the clients pool
         # - Undefined: defragmented packet if not a window probe
         eoc_received = False
-        match packet["msg_type"]:
+        match packet.msg_type:
             case self.net_task.FIRST_CONNECTION:
-                # Send tasks to the agent
+                # Set the FEC group size proposed by the agent and send tasks to the agent
+                self.pool.set_client_fec_group_size(agent_id, self.get_fec_group_size(packet))
                 self.send_tasks(agent_id, addr)
             case self.net_task.SEND_METRICS:
-                metrics = json.loads(packet["data"])
+                metrics = json.loads(packet.text)
                 self.ui.save_metrics(agent_id, metrics)
             case self.net_task.EOC:
                 eoc_received = True
             case self.net_task.UNDEFINED:
-                window_probe = packet["flags"].get("window_probe", 0)
+                window_probe = packet.window_probe
                 if window_probe == 0 and self.verbose and self.ui.view_mode:
-                    print(f"Defragmented packet: {json.dumps(packet, indent=2)}")
+                    print(f"Defragmented packet: {json.dumps(packet.to_dict(), indent=2)}")
 
         # De/fragmentation test
         # self.send("A" * 3000, {}, self.net_task.UNDEFINED, agent_id, addr)
@@ -218,37 +394,120 @@ class UDP(threading.Thread):
             self.pool.remove_client(agent_id)
             self.ui.save_status(f"Agent {agent_id} disconnected.")
 
-    def send(self, data, flags, msg_type, agent_id, addr):
-        seq_number = self.pool.get_seq_number(agent_id)
-        window_size = self.pool.get_server_window_size()
-        seq_number, packets = self.net_task.build_packet(self.net_task, data, seq_number, flags,
-                                                         msg_type, agent_id, window_size)
+    # FEC group size proposed by an agent in the data of the first connection,
+    # 0 if the agent didn't propose any
+    def get_fec_group_size(self, packet):
+        if len(packet.data) == 0:
+            return 0
+        try:
+            return int(json.loads(packet.text).get("fec_group_size", 0))
+        except (ValueError, TypeError, AttributeError):
+            self.ui.display_warning(f"Invalid first connection data from {packet.identifier}")
+            return 0
 
-        # set the sequence number
-        self.pool.set_seq_number(agent_id, seq_number)
+    def send_ack(self, packet, agent_id, addr):
+        # this ACK also acknowledges the packets of a delayed ACK
+        self.cancel_delayed_ack(agent_id)
+
+        window_size = self.get_window_size(agent_id)
+        ack_block = self.pool.get_ack_block(agent_id)
+        ack_packet = self.net_task.build_ack_packet(packet, agent_id, window_size, ack_block)
 
+        self.send_datagram([ack_packet], addr)
+
+        if self.verbose and self.ui.view_mode:
+            print(f"Sending ACK for packet {packet.seq_number} to {agent_id}")
+
+    def send_nack(self, seq_numbers, msg_id, agent_id, addr):
+        window_size = self.get_window_size(agent_id)
+        nack_packet = self.net_task.build_nack_packet(seq_numbers, msg_id, agent_id, window_size)
+
+        self.send_datagram([nack_packet], addr)
+
+        if self.verbose and self.ui.view_mode:
+            print(f"Sending NACK for packets {seq_numbers} to {agent_id}")
+
+    def send(self, data, flags, msg_type, agent_id, addr):
         # Flux control by checking the window size
-        # if the URG flag is set, send the packet immediately, regardless of the window size
+        # if the URG flag is set, send the packet immediately, regardless of the window size,
+        # otherwise the packets are queued and sent as the window size allows, the caller
+        # doesn't wait for the window, as it can be the worker handling the agent packets
         # if the window size received is 0, the window size control thread will send window probe
         # packets to the agents with window size 0
         urgent = flags.get("urgent", 0)
+
+        # piggyback the delayed ACK of the agent, if any, on the data sent, unless
+        # the data is queued behind other packets, or waits for the window or the pacing
+        ack_block = None
+        if data and self.pool.can_send_packets(agent_id) and self.cancel_delayed_ack(agent_id):
+            ack_block = self.pool.get_ack_block(agent_id)
+
+        # the fragments of the messages queued are protected by parity packets (FEC),
+        # if negotiated with the agent
+        fec_group_size = self.pool.get_client_fec_group_size(agent_id) if urgent == 0 else 0
+
+        seq_number = self.pool.get_seq_number(agent_id)
+        window_size = self.get_window_size(agent_id)
+        seq_number, fragments = self.net_task.build_fragments(self.net_task, data, seq_number,
+                                                              flags, msg_type, agent_id,
+                                                              window_size, ack_block,
+                                                              fec_group_size)
+
+        # set the sequence number
+        self.pool.set_seq_number(agent_id, seq_number)
+
+        # urgent packets are sent right away, the others are queued and sent as the
+        # agent window size allows, the next ones being sent as the ACKs arrive
         if urgent == 0:
-            while self.pool.get_client_window_size(agent_id) <= 0:
-                time.sleep(1)
-                if self.verbose and self.ui.view_mode:
-                    print(f"Agent {agent_id} window size is 0 or less. Waiting...")
+            self.pool.queue_packets_to_send(agent_id, fragments)
+            self.send_packets(agent_id, addr)
+            return
+
+        rto = self.pool.get_rto(agent_id)
+        for packet in fragments:
+            # add the packet to the list of packets to be acknowledged and start the
+            # retransmission timer before sending, as the ACK can arrive first
+            self.pool.add_packet_to_ack(agent_id, packet)
+            self.start_retransmit_timer(agent_id, packet, rto)
+            self.send_packet(packet, agent_id, addr)
+
+    # Send the packets queued to an agent that fit in its window size
+    def send_packets(self, agent_id, addr):
+        retransmissions, packets, delay = self.pool.take_packets_to_send(agent_id)
+
+        rto = self.pool.get_rto(agent_id)
+        for packet in retransmissions:
+            packet.cancel_timer()
+            self.retransmit(agent_id, packet, addr, rto)
 
         for packet in packets:
-            with self.lock:
-                self.server_socket.sendto(packet, addr)
+            self.start_retransmit_timer(agent_id, packet, rto)
+            self.send_packet(packet, agent_id, addr)
 
-            # parse the packet to save it in the list of packets to be acknowledged
-            tmp_packet = self.net_task.parse_packet(self.net_task, packet)
-            # add the packet to the list of packets to be acknowledged
-            self.pool.add_packet_to_ack(agent_id, tmp_packet)
+        # send the next packets once the pacing allows
+        if delay is not None:
+            self.start_pacing_timer(agent_id, addr, delay)
 
-            if self.verbose and self.ui.view_mode:
-                print(f"Sending packet: {json.dumps(tmp_packet, indent=2)}")
+    def start_pacing_timer(self, agent_id, addr, delay):
+        with self.lock:
+            if agent_id not in self.pacing_timers:
+                self.pacing_timers[agent_id] = self.timers.schedule(
+                    delay, self.pacing_timeout, agent_id, addr)
+
+    def pacing_timeout(self, agent_id, addr):
+        with self.lock:
+            self.pacing_timers.pop(agent_id, None)
+        self.send_packets(agent_id, addr)
+
+    # Send a packet for the first time, followed by the parity packet
+    # of its group (FEC), if it's the last fragment of the group
+    def send_packet(self, packet, agent_id, addr):
+        self.send_datagram(packet.buffers, addr)
+        if packet.parity_packet is not None:
+            self.send_datagram(packet.parity_packet.buffers, addr)
+
+        if self.verbose and self.ui.view_mode:
+            print(f"Sending packet: {json.dumps(packet.to_dict(), indent=2)}")
 
     def send_tasks(self, agent_id, addr):
         tasks = self.task_server.get_agent_tasks(agent_id)
@@ -264,16 +523,26 @@ class UDP(threading.Thread):
         # Get the connected agents and respective addresses
         agents = self.pool.get_connected_clients()
 
-        # For each agent, send the EOC packet
-        for agent_id in self.pool.get_connected_clients():
+        # For each agent, send the EOC packet, paced so the
+        # EOC packets to many agents aren't sent in a single burst,
+        # skipping the agents disconnected while the others were sent
+        pacer = TokenBucket(C.BROADCAST_RATE, C.BROADCAST_BURST, time.monotonic())
+        for agent_id in list(agents):
             addr = agents[agent_id]
             msg_type = self.net_task.EOC
 
+            time.sleep(pacer.reserve(time.monotonic()))
+            if not self.pool.is_client_connected(agent_id):
+                continue
             self.send("", {"urgent": 1}, msg_type, agent_id, addr)
 
+            # Drop the agent if the EOC isn't acknowledged in time
+            self.timers.schedule(C.EOC_ACK_TIMEOUT, self.eoc_timeout, agent_id)
+
     def shutdown(self):
         # Signal all threads to stop
         self.shutdown_flag.set()
+        self.timers.shutdown()
 
         # Close the socket
         try:
@@ -281,6 +550,10 @@ class UDP(threading.Thread):
         except OSError as e:
             self.ui.display_error(f"Error closing UDP socket: {e}")
 
+        # Stop the workers once the packets queued are handled
+        self.workers.shutdown()
+        self.workers.join()
+
         # Wait for all threads to finish
         for thread in self.threads:
             if thread.is_alive():
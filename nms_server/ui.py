@@ -5,11 +5,10 @@ import sql.database as db
 
 
 class UI:
-    def __init__(self, server_hostname, pool, verbose=False):
+    def __init__(self, server_hostname, verbose=False):
         self.running = True
         self.view_mode = False  # Real-time view mode
         self.server_hostname = server_hostname
-        self.pool = pool
         self.verbose = verbose
 
     def display_title(self):
@@ -68,20 +67,37 @@ class UI:
                 input()
                 self.view_mode = False
             case 3:
-                agents = self.pool.get_connected_clients()
+                agents = udp_server.get_clients_stats()
                 n = len(agents)
                 if n == 0:
                     print("No agents connected.")
                 else:
                     print(f"{len(agents)} Connected Agents:")
-                    for agent in agents:
+                    for agent, stats in agents.items():
                         print(f"Agent: {agent}")
+                        if stats["srtt"] is None:
+                            print(f"SRTT: - | RTTVAR: - | RTO: {stats['rto'] * 1000:.1f} ms")
+                        else:
+                            print(f"SRTT: {stats['srtt'] * 1000:.1f} ms | "
+                                  f"RTTVAR: {stats['rttvar'] * 1000:.1f} ms | "
+                                  f"RTO: {stats['rto'] * 1000:.1f} ms")
                         if self.verbose:
-                            print(f"Address: {agents[agent]}")
-                            print(f"Sequence Number: {self.pool.get_seq_number(agent)}")
-                            print(f"Packets to Ack: {self.pool.packets_to_ack[agent]}")
-                            print(f"Packets to Reorder: {self.pool.packets_to_reorder[agent]}")
-                            print(f"Window Size: {self.pool.agents_window_sizes[agent]}")
+                            print(f"Address: {stats['address']}")
+                            print(f"Sequence Number: {stats['seq_number']}")
+                            print(f"Packets to Ack: {stats['packets_to_ack']} | "
+                                  f"Packets to Reorder: {stats['packets_to_reorder']}")
+                            print(f"Window Size: {stats['client_window_size']} | "
+                                  f"Server Window Size: {stats['server_window_size']} | "
+                                  f"Congestion Window: {stats['congestion_window']}")
+                if self.verbose:
+                    stats = udp_server.get_reassembly_stats()
+                    print(f"Reassembly: {stats['buffered_bytes']} bytes buffered | "
+                          f"Evicted: {stats['evicted_messages']} messages, "
+                          f"{stats['evicted_fragments']} fragments | "
+                          f"Over budget: {stats['dropped_fragments']} fragments")
+                    queued, dropped = udp_server.get_handler_stats()
+                    print(f"Handler queue: {queued} packets queued | "
+                          f"Dropped: {dropped} packets")
             case 4:
                 limit = self.get_limit_value()
                 logs = db.operation.select_logs(limit)
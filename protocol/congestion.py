@@ -0,0 +1,107 @@
+# Congestion control and pacing of the packets sent to a NetTask peer.
+#
+# The congestion window bounds the packets in flight along with the window size
+# advertised by the peer. It grows by a packet for each packet acknowledged in
+# slow start, and by a packet per window acknowledged in congestion avoidance
+# (additive increase). A retransmission timeout collapses it to a packet, and a
+# NACK halves it (multiplicative decrease), at most once per retransmission
+# timeout, as the losses of the same window are detected together.
+#
+# The packets are paced by a token bucket, refilled at the rate of a congestion
+# window per round-trip time, so a window isn't sent in a single burst.
+
+import constants as C
+
+# Pacing rate, relative to a congestion window per round-trip time
+PACING_GAIN = 1.25
+
+
+class CongestionWindow:
+    __slots__ = ("cwnd", "ssthresh", "last_decrease")
+
+    def __init__(self):
+        self.cwnd          = C.INITIAL_CONGESTION_WINDOW
+        self.ssthresh      = C.MAX_CONGESTION_WINDOW  # Slow start threshold
+        self.last_decrease = None                     # Time of the last decrease
+
+    # Number of packets allowed in flight
+    @property
+    def window(self):
+        return int(self.cwnd)
+
+    def in_slow_start(self):
+        return self.cwnd < self.ssthresh
+
+    # Grow the window with the packets acknowledged
+    def on_ack(self, nr_packets):
+        for _ in range(nr_packets):
+            if self.in_slow_start():
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, C.MAX_CONGESTION_WINDOW)
+
+    # Shrink the window after a loss, detected by a retransmission timeout or
+    # reported by a NACK, unless it was already shrunk in the last interval
+    # (the retransmission timeout, as the losses of a window are detected within it)
+    def on_loss(self, now, interval, timeout):
+        if self.last_decrease is not None and now - self.last_decrease < interval:
+            return
+
+        self.ssthresh = max(self.cwnd / 2, C.MIN_CONGESTION_WINDOW * 2)
+        self.cwnd = C.MIN_CONGESTION_WINDOW if timeout else self.ssthresh
+        self.last_decrease = now
+
+    def __repr__(self):
+        return f"CongestionWindow(cwnd={self.cwnd:.2f}, ssthresh={self.ssthresh:.2f})"
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "last_time")
+
+    # Bucket refilled at a rate (tokens per second, None for no limit), up to a capacity
+    def __init__(self, rate, capacity, now):
+        self.rate      = rate
+        self.capacity  = capacity
+        self.tokens    = capacity
+        self.last_time = now
+
+    def refill(self, now):
+        if self.rate is None:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def set_rate(self, rate, now):
+        self.refill(now)
+        self.rate = rate
+
+    # Check if a token is available, without taking it
+    def available(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    # Take a token, return 0 if taken, otherwise the time until a token is available
+    def consume(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    # Take a token, even if not available yet, return the time until it's available
+    def reserve(self, now):
+        self.refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+# Pacing rate of a peer, a congestion window per round-trip time,
+# None (no pacing) until the round-trip time is sampled
+def pacing_rate(congestion, srtt):
+    if srtt is None:
+        return None
+    return PACING_GAIN * congestion.cwnd / max(srtt, C.MIN_PACING_RTT)
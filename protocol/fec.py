@@ -0,0 +1,72 @@
+# Forward error correction (FEC) of the fragmented NetTask messages.
+#
+# The fragments of a message are split in groups of k consecutive fragments, and a
+# parity fragment is sent after the last fragment of each group, with the XOR of the
+# data of the fragments of the group (padded with zeros to the longest one). A single
+# fragment missing from a group is rebuilt from the parity and the other fragments,
+# without waiting for its retransmission.
+#
+# Parity data:
+# - Group size       ( 1 byte)  number of fragments of the group
+# - Flags and Type   ( 1 byte)  XOR of the flags and type of the fragments
+# - Data size        ( 2 bytes) XOR of the data sizes of the fragments
+# - Parity           ( N bytes) XOR of the data of the fragments
+#
+# The group size (the redundancy, a parity fragment per k fragments) is proposed
+# by the agent on the first connection and used by both peers, 0 disables it.
+
+import struct
+import constants as C
+
+# Struct format for the parity header
+# !    network (big-endian) byte order
+# B    unsigned char       (1 byte)
+# H    unsigned short      (2 bytes)
+PARITY_STRUCT = struct.Struct('!B B H')
+PARITY_HEADER_SIZE = PARITY_STRUCT.size
+
+
+# Group size agreed with a peer, the one proposed within the bounds, or 0 (disabled)
+def negotiate_group_size(group_size):
+    if not group_size or group_size < 0:
+        return 0
+    return min(max(group_size, C.MIN_FEC_GROUP_SIZE), C.MAX_FEC_GROUP_SIZE)
+
+
+# XOR of the payloads, padded with zeros to a size
+def xor_payloads(payloads, size):
+    parity = 0
+    for payload in payloads:
+        parity ^= int.from_bytes(payload, "big") << (8 * (size - len(payload)))
+    return parity.to_bytes(size, "big")
+
+
+# Build the parity data of a group of fragments, from their data and flags and type
+def encode_parity(payloads, flags_types):
+    flags_type = 0
+    data_size = 0
+    for payload, fragment_flags_type in zip(payloads, flags_types):
+        flags_type ^= fragment_flags_type
+        data_size ^= len(payload)
+
+    size = max(len(payload) for payload in payloads)
+    return (PARITY_STRUCT.pack(len(payloads), flags_type, data_size)
+            + xor_payloads(payloads, size))
+
+
+# Number of fragments of the group of a parity data
+def parity_group_size(parity):
+    return parity[0] if len(parity) >= PARITY_HEADER_SIZE else 0
+
+
+# Rebuild the fragment missing from a group, from the parity data and the data and
+# flags and type of the other fragments, return its flags and type and its data
+def decode_parity(parity, payloads, flags_types):
+    _, flags_type, data_size = PARITY_STRUCT.unpack_from(parity)
+    for payload, fragment_flags_type in zip(payloads, flags_types):
+        flags_type ^= fragment_flags_type
+        data_size ^= len(payload)
+
+    xor = parity[PARITY_HEADER_SIZE:]
+    data = xor_payloads([xor, *payloads], len(xor))
+    return flags_type, data[:data_size]
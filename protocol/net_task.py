@@ -1,8 +1,15 @@
 # NetTask app protocol for communication between the server and the agents.
 
+import sys
+import zlib
 import struct
+import functools
+import threading
 import constants as C
 
+from .sack import ACK_BLOCK_STRUCT, ACK_BLOCK_SIZE, SEQ_MODULO
+from .fec  import PARITY_HEADER_SIZE, encode_parity, decode_parity, parity_group_size
+
 from .exceptions.invalid_version   import InvalidVersionException
 from .exceptions.invalid_header    import InvalidHeaderException
 from .exceptions.checksum_mismatch import ChecksumMismatchException
@@ -15,7 +22,7 @@ from .exceptions.checksum_mismatch import ChecksumMismatchException
 # - Checksum        ( 2 bytes)
 # - Message ID      ( 2 bytes)
 # - Identifier      (32 bytes) [Default: UTF-8]
-# - Data            ( N bytes) [Default: UTF-8] [If ACK: ACK seq. number]
+# - Data            ( N bytes) [Default: UTF-8] [If ACK: ACK block (versions 3 and 4)]
 
 # Packet flags:
 # ARUWF0000 where:
@@ -28,13 +35,33 @@ from .exceptions.checksum_mismatch import ChecksumMismatchException
 # _____010 - 2 - Send task        [Server  -> Agent]
 # _____011 - 3 - Send metrics     [Server  <- Agent]
 # _____100 - 4 - EOC              [Server <-> Agent]
+# _____101 - 5 - NACK             [Server <-> Agent]
+# _____110 - 6 - Parity (FEC)     [Server <-> Agent]
 # _____*** - Reserved message types
 
+# NetTask versions (the version defines the checksum algorithm and the ACKs):
+# - 1: 16-bit one's complement sum of the packet (RFC 1071)
+# - 2: CRC32 (zlib) of the packet, folded to 16 bits
+# - 3: 16-bit checksum, cumulative and selective ACKs
+# - 4: CRC32 checksum, cumulative and selective ACKs
+
 # Integers like sequence number, fragment offset, window size, and ACK seq. number
 # are stored in network byte order (big-endian) unsigned integers.
 
-# If the flag ACK is set, the payload data will be empty, and the sequence number
-# represents the sequence number of the packet being acknowledged.
+# If the flag ACK is set, the sequence number represents the sequence number of
+# the packet being acknowledged. In versions 1 and 2 the payload data will be empty.
+# In versions 3 and 4 the data starts with an ACK block (see sack.py), with the
+# cumulative ACK number and the SACK bitmap of the packets received.
+
+# If the type is NACK, the data is the list of sequence numbers (2 bytes each) of
+# the fragments missing from a message, to be retransmitted right away. NACKs don't
+# take a sequence number and aren't acknowledged nor retransmitted.
+
+# If the type is Parity, the data is the parity of a group of fragments of a message
+# (see fec.py), sent after the last fragment of the group, and the sequence number
+# is the one of the first fragment of the group. Parity packets don't take a sequence
+# number of their own and aren't acknowledged nor retransmitted, the fragment they
+# rebuild is acknowledged as if it was received.
 
 
 ###
@@ -54,6 +81,18 @@ SIZE_IDENTIFIER  = 32
 HEADER_SIZE = (SIZE_NMS_VERSION + SIZE_SEQ_NUMBER + SIZE_FLAGS_TYPE +
                SIZE_WINDOW_SIZE + SIZE_CHECKSUM + SIZE_MSG_ID + SIZE_IDENTIFIER)
 
+# Offset of the flags and type field in the header, it's the low
+# byte of the 16-bit word starting at the sequence number low byte
+FLAGS_TYPE_OFFSET = SIZE_NMS_VERSION + SIZE_SEQ_NUMBER
+
+# Offsets of the checksum field in the header
+CHECKSUM_START = SIZE_NMS_VERSION + SIZE_SEQ_NUMBER + SIZE_FLAGS_TYPE + SIZE_WINDOW_SIZE
+CHECKSUM_END   = CHECKSUM_START + SIZE_CHECKSUM
+
+# Offsets of the identifier field in the header
+IDENTIFIER_START = CHECKSUM_END + SIZE_MSG_ID
+IDENTIFIER_END   = IDENTIFIER_START + SIZE_IDENTIFIER
+
 # Struct format for the header fields
 # !    network (big-endian) byte order
 # B    unsigned char       (1 byte)
@@ -63,6 +102,351 @@ HEADER_SIZE = (SIZE_NMS_VERSION + SIZE_SEQ_NUMBER + SIZE_FLAGS_TYPE +
 # Xs   string with X chars (X bytes)
 STRUCT_FORMAT = '!B H B h H H 32s'
 
+# Precompiled structs for the header, the checksum field and the sequence numbers
+HEADER_STRUCT     = struct.Struct(STRUCT_FORMAT)
+CHECKSUM_STRUCT   = struct.Struct('!H')
+SEQ_NUMBER_STRUCT = struct.Struct('!H')
+
+# Maximum number of sequence numbers in a NACK
+MAX_NACK_SEQ_NUMBERS = (C.BUFFER_SIZE - HEADER_SIZE) // SIZE_SEQ_NUMBER
+
+# Bits of the flags and type field
+ACK_FLAG            = 0b10000000
+RETRANSMISSION_FLAG = 0b01000000
+URGENT_FLAG         = 0b00100000
+WINDOW_PROBE_FLAG   = 0b00010000
+MORE_FRAGMENTS_FLAG = 0b00001000
+MSG_TYPE_MASK       = 0b00000111
+
+
+###
+# Checksum algorithms
+###
+
+# The one's complement sum doesn't depend on the byte order (RFC 1071), so the
+# words are summed in the host byte order and the result is swapped at the end
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+# 16-bit one's complement sum of a sequence of memoryviews.
+# Every view but the last must have an even length, so the 16-bit words stay aligned.
+# The views are summed in bulk as 64-bit words, since 2^16 = 1 (mod 2^16 - 1),
+# folding the total to 16 bits gives the same result as summing 16-bit words.
+def checksum_sum16(views):
+    checksum = 0
+    for view in views:
+        length = len(view)
+        end_q = length & ~7
+        end_h = length & ~1
+        if end_q:
+            checksum += sum(view[:end_q].cast('Q'))
+        if end_h > end_q:
+            checksum += sum(view[end_q:end_h].cast('H'))
+        if length > end_h:
+            # If there's a single byte left, pad it
+            checksum += view[end_h] if LITTLE_ENDIAN else view[end_h] << 8
+
+    # Fold the checksum to 16-bit
+    while checksum > 0xFFFF:
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)
+
+    # Swap back to network byte order
+    if LITTLE_ENDIAN:
+        checksum = ((checksum & 0xFF) << 8) | (checksum >> 8)
+
+    # Return the one's complement of the checksum
+    return ~checksum & 0xFFFF
+
+
+# Incremental update of the 16-bit checksum when a 16-bit word
+# of the packet changes, without summing the packet again (RFC 1624)
+def update_checksum_sum16(checksum, old_word, new_word):
+    checksum = (~checksum & 0xFFFF) + (~old_word & 0xFFFF) + new_word
+    checksum = (checksum & 0xFFFF) + (checksum >> 16)
+    checksum = (checksum & 0xFFFF) + (checksum >> 16)
+    return ~checksum & 0xFFFF
+
+
+# CRC32 of a sequence of memoryviews, folded to 16 bits to fit the checksum field
+def checksum_crc32(views):
+    crc = 0
+    for view in views:
+        crc = zlib.crc32(view, crc)
+
+    return (crc ^ (crc >> 16)) & 0xFFFF
+
+
+# Checksum algorithm used by each supported NetTask version
+CHECKSUM_ALGORITHMS = {
+    1: checksum_sum16,
+    2: checksum_crc32,
+    3: checksum_sum16,
+    4: checksum_crc32,
+}
+
+# NetTask versions with cumulative and selective ACKs
+SACK_VERSIONS = {3, 4}
+
+
+###
+# Header building helpers
+###
+
+# Reusable header buffers, one per thread, as packets are built concurrently
+header_buffers = threading.local()
+
+
+def header_buffer():
+    try:
+        return header_buffers.buffer
+    except AttributeError:
+        header_buffers.buffer = bytearray(HEADER_SIZE)
+        return header_buffers.buffer
+
+
+# Encode the identifier once, as the same identifiers are used for all
+# the packets of a session. Identifiers already encoded are returned as is.
+@functools.lru_cache(maxsize=4096)
+def encode_identifier(identifier):
+    if isinstance(identifier, str):
+        return identifier.encode(C.ENCODING)
+    return identifier
+
+
+# Decode an identifier, removing the padding
+@functools.lru_cache(maxsize=4096)
+def decode_identifier(identifier):
+    return identifier.rstrip(b'\x00').decode(C.ENCODING)
+
+
+# Get the identifier of a raw packet, without parsing nor checking it,
+# to dispatch the packets of a peer before they are handled
+def peek_identifier(raw):
+    return raw[IDENTIFIER_START:IDENTIFIER_END]
+
+
+# Identifier padded as in the header, the one got by peek_identifier
+@functools.lru_cache(maxsize=4096)
+def pad_identifier(identifier):
+    return encode_identifier(identifier)[:SIZE_IDENTIFIER].ljust(SIZE_IDENTIFIER, b'\x00')
+
+
+# Build the flags and type field from a dict of flags and the message type
+def build_flags_type(flags, msg_type):
+    return (
+        (flags.get("ack",            0) << 7) |
+        (flags.get("retransmission", 0) << 6) |
+        (flags.get("urgent",         0) << 5) |
+        (flags.get("window_probe",   0) << 4) |
+        (flags.get("more_fragments", 0) << 3) |
+        (msg_type & MSG_TYPE_MASK)
+    )
+
+
+###
+# NetTask Packets
+###
+
+# Flags and message type decoded from the flags and type field only when accessed
+class PacketFlags:
+    __slots__ = ()
+
+    @property
+    def ack(self):
+        return (self.flags_type & ACK_FLAG) >> 7
+
+    @property
+    def retransmission(self):
+        return (self.flags_type & RETRANSMISSION_FLAG) >> 6
+
+    @property
+    def urgent(self):
+        return (self.flags_type & URGENT_FLAG) >> 5
+
+    @property
+    def window_probe(self):
+        return (self.flags_type & WINDOW_PROBE_FLAG) >> 4
+
+    @property
+    def more_fragments(self):
+        return (self.flags_type & MORE_FRAGMENTS_FLAG) >> 3
+
+    @property
+    def msg_type(self):
+        return self.flags_type & MSG_TYPE_MASK
+
+    @property
+    def flags(self):
+        return {
+            "ack": self.ack,
+            "retransmission": self.retransmission,
+            "urgent": self.urgent,
+            "window_probe": self.window_probe,
+            "more_fragments": self.more_fragments,
+        }
+
+
+# Parsed NetTask packet, a compact view over the received datagram.
+# The data is kept as a memoryview, decoded only when the text is requested.
+class NetTaskPacket(PacketFlags):
+    __slots__ = ("raw", "version", "seq_number", "flags_type", "window_size",
+                 "checksum", "msg_id", "raw_identifier", "data", "ack_block", "_text")
+
+    def __init__(self, raw, version, seq_number, flags_type, window_size,
+                 checksum, msg_id, raw_identifier, data, ack_block=None):
+        self.raw            = raw
+        self.version        = version
+        self.seq_number     = seq_number
+        self.flags_type     = flags_type
+        self.window_size    = window_size
+        self.checksum       = checksum
+        self.msg_id         = msg_id
+        self.raw_identifier = raw_identifier
+        self.data           = data
+        self.ack_block      = ack_block  # (ACK number, SACK bitmap) or None
+        self._text          = None
+
+    # Identifier without padding
+    @property
+    def identifier(self):
+        return decode_identifier(self.raw_identifier)
+
+    # Data decoded as text
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = str(self.data, C.ENCODING)
+        return self._text
+
+    # Sequence numbers of the packets missing, listed in a NACK
+    @property
+    def nack_seq_numbers(self):
+        data = self.data[:len(self.data) - len(self.data) % SIZE_SEQ_NUMBER]
+        return [seq_number for seq_number, in SEQ_NUMBER_STRUCT.iter_unpack(data)]
+
+    # Parity of a group of fragments (FEC)
+    @property
+    def parity(self):
+        return self.msg_type == NetTask.PARITY
+
+    # Sequence numbers of the fragments of the group of a parity packet
+    @property
+    def parity_seq_numbers(self):
+        return [(self.seq_number + index) % SEQ_MODULO
+                for index in range(parity_group_size(self.data))]
+
+    # ACK piggybacked on a data packet, the ACK block acknowledges the packets
+    # received and the data is processed as in any other packet
+    @property
+    def piggybacked(self):
+        return self.ack_block is not None and len(self.data) > 0
+
+    # Copy of the packet with other data, used for the defragmented packets
+    def with_data(self, data):
+        return NetTaskPacket(self.raw, self.version, self.seq_number, self.flags_type,
+                             self.window_size, self.checksum, self.msg_id,
+                             self.raw_identifier, memoryview(data), self.ack_block)
+
+    def __repr__(self):
+        return (f"NetTaskPacket(seq_number={self.seq_number}, msg_id={self.msg_id}, "
+                f"flags_type={self.flags_type:#010b}, data_size={len(self.data)})")
+
+    # Packet as a dict, for displaying purposes
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "seq_number": self.seq_number,
+            "flags": self.flags,
+            "msg_type": self.msg_type,
+            "window_size": self.window_size,
+            "checksum": self.checksum,
+            "msg_id": self.msg_id,
+            "identifier": self.identifier,
+            "ack_block": self.ack_block,
+            "data": str(self.data, C.ENCODING, "replace")
+        }
+
+
+# Packet built to be sent, the header and the data are kept apart to
+# be sent with a scatter-gather sendmsg, along with the header fields
+# needed to track the packet until it's acknowledged.
+# The encoded packet is kept as sent, so it can be retransmitted verbatim.
+# The last fragment of a parity group (FEC) keeps the parity packet, sent after it.
+class OutboundPacket(PacketFlags):
+    __slots__ = ("header", "data", "seq_number", "msg_id", "flags_type",
+                 "sent_time", "deadline", "retransmissions", "timer", "parity_packet")
+
+    def __init__(self, header, data, seq_number, msg_id, flags_type):
+        self.header          = header
+        self.data            = data
+        self.seq_number      = seq_number
+        self.msg_id          = msg_id
+        self.flags_type      = flags_type
+        self.sent_time       = None
+        self.deadline        = None
+        self.retransmissions = 0
+        self.timer           = None
+        self.parity_packet   = None
+
+    # Set the retransmission timer of the packet, scheduled in the timer service
+    def set_timer(self, now, timeout, timer):
+        self.sent_time = now
+        self.deadline  = now + timeout
+        self.timer     = timer
+
+    # Cancel the retransmission timer, once the packet is acknowledged
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    # Retransmission timeout the packet was last sent with
+    @property
+    def rto(self):
+        return self.deadline - self.sent_time
+
+    # Set the retransmission flag by patching the header in place.
+    # With the 16-bit checksum, the checksum is updated incrementally,
+    # otherwise it's calculated again.
+    def set_retransmission_flag(self):
+        self.retransmissions += 1
+        if self.flags_type & RETRANSMISSION_FLAG:
+            return
+
+        header = self.header
+        old_word = (header[FLAGS_TYPE_OFFSET - 1] << 8) | header[FLAGS_TYPE_OFFSET]
+
+        self.flags_type |= RETRANSMISSION_FLAG
+        header[FLAGS_TYPE_OFFSET] = self.flags_type
+
+        version = header[0]
+        if CHECKSUM_ALGORITHMS[version] is checksum_sum16:
+            new_word = (header[FLAGS_TYPE_OFFSET - 1] << 8) | header[FLAGS_TYPE_OFFSET]
+            checksum, = CHECKSUM_STRUCT.unpack_from(header, CHECKSUM_START)
+            checksum = update_checksum_sum16(checksum, old_word, new_word)
+        else:
+            checksum = NetTask.calculate_checksum(header, self.data, version)
+
+        CHECKSUM_STRUCT.pack_into(header, CHECKSUM_START, checksum)
+
+    # Buffers to be sent with sendmsg
+    @property
+    def buffers(self):
+        return [self.header, self.data]
+
+    def __repr__(self):
+        return (f"OutboundPacket(seq_number={self.seq_number}, msg_id={self.msg_id}, "
+                f"flags_type={self.flags_type:#010b}, data_size={len(self.data)})")
+
+    # Packet as a dict, for displaying purposes
+    def to_dict(self):
+        return {
+            "seq_number": self.seq_number,
+            "flags": self.flags,
+            "msg_type": self.msg_type,
+            "msg_id": self.msg_id,
+            "data": str(self.data, C.ENCODING, "replace")
+        }
+
 
 ###
 # NetTask Main Class
@@ -75,201 +459,253 @@ class NetTask:
     SEND_TASKS       = 2
     SEND_METRICS     = 3
     EOC              = 4
+    NACK             = 5
+    PARITY           = 6
 
-    # Calculate the checksum of a packet, padding the checksum field with 0
+    # Calculate the checksum of a packet, skipping the checksum field.
+    # The data can be passed separately from the header, so both don't
+    # need to be concatenated. The algorithm is given by the NetTask version.
     @staticmethod
-    def calculate_checksum(packet):
-        checksum_start = (SIZE_NMS_VERSION + SIZE_SEQ_NUMBER + SIZE_FLAGS_TYPE +
-                          SIZE_WINDOW_SIZE)
-        checksum_end = checksum_start + SIZE_CHECKSUM
-        data = packet[:checksum_start] + packet[checksum_end:]
-
-        # Calculate a 16-bit checksum of the packet
-        checksum = 0
-        for i in range(0, len(data), 2):
-            part = data[i:i + 2]
-            if len(part) == 1:
-                # If there's a single byte left, pad it
-                part += b'\x00'
-            checksum += int.from_bytes(part, 'big')
-
-        # Fold 32-bit checksum to 16-bit
-        while checksum > 0xFFFF:
-            checksum = (checksum & 0xFFFF) + (checksum >> 16)
-
-        # Return the one's complement of the checksum
-        return ~checksum & 0xFFFF
-
-    # usage: ack_flag, parsed_packet = NetTask.parser(packet)
+    def calculate_checksum(packet, data=b"", version=None):
+        if version is None:
+            version = C.NET_TASK_VERSION
+
+        packet = memoryview(packet)
+        views = (packet[:CHECKSUM_START], packet[CHECKSUM_END:], memoryview(data))
+
+        return CHECKSUM_ALGORITHMS[version](views)
+
+    # Parse a datagram to a NetTaskPacket, a view over the datagram without copies
+    # usage: packet = NetTask.parse_packet(NetTask, datagram)
     @staticmethod
     def parse_packet(self, packet):
-        # Extract the header and data
-        header = packet[:HEADER_SIZE]
-        data = packet[HEADER_SIZE:]
-
         # Unpack the header fields
         try:
             # Check if the NMS NetTask version is correct before unpacking the rest of the header
-            version = header[:SIZE_NMS_VERSION]
-            version = int.from_bytes(version, byteorder='big')
-            if version != C.NET_TASK_VERSION:
+            version = packet[0]
+            if version not in CHECKSUM_ALGORITHMS:
                 raise InvalidVersionException(version, C.NET_TASK_VERSION)
 
             version, seq_number, flags_type, window_size, \
-                checksum, msg_id, identifier = struct.unpack(STRUCT_FORMAT, header)
+                checksum, msg_id, identifier = HEADER_STRUCT.unpack_from(packet)
 
         except Exception:
             raise InvalidHeaderException()
 
         # Checksum validation
-        if self.calculate_checksum(packet) != checksum:
-            print(f"Checksum mismatch: {self.calculate_checksum(packet)} != {checksum}")
+        calculated_checksum = self.calculate_checksum(packet, version=version)
+        if calculated_checksum != checksum:
+            print(f"Checksum mismatch: {calculated_checksum} != {checksum}")
             raise ChecksumMismatchException()
 
-        # Parse flags and message type
-        ack_flag            = (flags_type & 0b10000000) >> 7
-        retransmission_flag = (flags_type & 0b01000000) >> 6
-        urgent_flag         = (flags_type & 0b00100000) >> 5
-        window_probe_flag   = (flags_type & 0b00010000) >> 4
-        more_fragments_flag = (flags_type & 0b00001000) >> 3
-        msg_type            = (flags_type & 0b00000111)
+        view = memoryview(packet)
+        data = view[HEADER_SIZE:]
 
-        # Remove padding from the identifier
-        identifier = identifier.rstrip(b'\x00')
+        # Split the ACK block from the data
+        ack_block = None
+        if flags_type & ACK_FLAG and version in SACK_VERSIONS and len(data) >= ACK_BLOCK_SIZE:
+            ack_block = ACK_BLOCK_STRUCT.unpack_from(data)
+            data = data[ACK_BLOCK_SIZE:]
 
-        return {
-            "version": version,
-            "seq_number": seq_number,
-            "flags": {
-                "ack": ack_flag,
-                "retransmission": retransmission_flag,
-                "urgent": urgent_flag,
-                "window_probe": window_probe_flag,
-                "more_fragments": more_fragments_flag,
-            },
-            "msg_type": msg_type,
-            "window_size": window_size,
-            "checksum": checksum,
-            "msg_id": msg_id,
-            "identifier": identifier.decode(C.ENCODING),
-            "data": data.decode(C.ENCODING)
-        }
+        return NetTaskPacket(view, version, seq_number, flags_type, window_size,
+                             checksum, msg_id, identifier, data, ack_block)
 
+    # Pack a header in the reusable buffer of the calling thread, the checksum
+    # is calculated with the field set to 0 and then patched in place
     @staticmethod
-    def build_header(self, seq_number, flags_type, window_size,
-                     msg_id, identifier, data):
-
-        # Initial header with checksum set to 0
-        header = struct.pack(
-            STRUCT_FORMAT,
-            C.NET_TASK_VERSION,
-            seq_number,
-            flags_type,
-            window_size,
-            0,  # Placeholder for checksum
-            msg_id,
-            identifier.encode(C.ENCODING)
-        )
+    def pack_header(self, seq_number, flags_type, window_size,
+                    msg_id, identifier, data):
 
-        # Concatenate header and data to calculate the checksum
         if isinstance(data, str):
             data = data.encode(C.ENCODING)
-        packet = header + data
-        checksum = self.calculate_checksum(packet)
 
-        # Repack the header with the actual checksum
-        header = struct.pack(
-            STRUCT_FORMAT,
+        buffer = header_buffer()
+        HEADER_STRUCT.pack_into(
+            buffer, 0,
             C.NET_TASK_VERSION,
             seq_number,
             flags_type,
             window_size,
-            checksum,
+            0,  # Placeholder for checksum
             msg_id,
-            identifier.encode(C.ENCODING)
+            encode_identifier(identifier)
         )
 
-        return header
+        # Calculate the checksum over the header and data and patch it in the header
+        checksum = self.calculate_checksum(buffer, data)
+        CHECKSUM_STRUCT.pack_into(buffer, CHECKSUM_START, checksum)
 
+        return buffer
+
+    @staticmethod
+    def build_header(self, seq_number, flags_type, window_size,
+                     msg_id, identifier, data):
+        return bytes(self.pack_header(self, seq_number, flags_type, window_size,
+                                      msg_id, identifier, data))
+
+    # Build the fragments of a message as outbound packets, the data of each
+    # fragment is a memoryview of the message data, so the header and the data
+    # can be sent with a scatter-gather sendmsg without being concatenated.
+    # An ACK block (ACK number, SACK bitmap) can be piggybacked on the first
+    # fragment, if the NetTask version supports it and the message has data.
+    # With a FEC group size, the fragments of a fragmented message are protected
+    # by a parity packet per group, kept by the last fragment of the group
     @staticmethod
-    def build_packet(self, data, seq_number, flags, msg_type, identifier, window_size):
+    def build_fragments(self, data, seq_number, flags, msg_type, identifier, window_size,
+                        ack_block=None, fec_group_size=0):
 
         if isinstance(data, str):
             data = data.encode(C.ENCODING)
+        data = memoryview(data)
 
-        # Set flags and type field
-        flags_type = (
-            (flags.get("ack",            0) << 7) |
-            (flags.get("retransmission", 0) << 6) |
-            (flags.get("urgent",         0) << 5) |
-            (flags.get("window_probe",   0) << 4) |
-            (flags.get("more_fragments", 0) << 3) |
-            (msg_type & 0b00000111)
-        )
+        # Set flags and type field, the "more fragments" flag is set per fragment, and
+        # the ACK flag only on the fragment with the ACK block, as the ACK flag of a
+        # data packet tells the ACK block is at the start of its data
+        flags_type = build_flags_type(flags, msg_type) & ~(MORE_FRAGMENTS_FLAG | ACK_FLAG)
 
-        packets = []
+        ack_prefix = b""
+        if ack_block is not None and C.NET_TASK_VERSION in SACK_VERSIONS and len(data) > 0:
+            ack_prefix = ACK_BLOCK_STRUCT.pack(*ack_block)
+
+        fragments = []
         msg_id = seq_number
 
-        # Split the data to fragments of size NET_TASK_BUFFER_SIZE (default: 1500 bytes)
+        # Split the data to fragments of size NET_TASK_BUFFER_SIZE (default: 1500 bytes),
+        # the ACK block takes space from the data of the first fragment, and
+        # the parity header from the data of all the fragments, with FEC
         data_chunk_size = C.BUFFER_SIZE - HEADER_SIZE
+        if fec_group_size > 0:
+            data_chunk_size -= PARITY_HEADER_SIZE
+        offset = 0
+
+        while True:
+            fragment_flags_type = flags_type
+            data_segment = data[offset:offset + data_chunk_size - len(ack_prefix)]
+            offset += len(data_segment)
+
+            if ack_prefix:
+                fragment_flags_type |= ACK_FLAG
+                data_segment = memoryview(ack_prefix + data_segment)
+                ack_prefix = b""
+
+            # Set the "more_fragments" flag on all fragments but the last
+            if offset < len(data):
+                fragment_flags_type |= MORE_FRAGMENTS_FLAG
+
+            # The header is kept mutable, to set the flags on retransmissions
+            header = bytearray(self.pack_header(self,
+                                                seq_number,
+                                                fragment_flags_type,
+                                                window_size,
+                                                msg_id,
+                                                identifier,
+                                                data_segment))
+
+            fragments.append(OutboundPacket(header, data_segment, seq_number,
+                                            msg_id, fragment_flags_type))
+
+            # Increment the sequence number for the next fragment, wrapping at 16 bits
+            seq_number = (seq_number + 1) % SEQ_MODULO
+
+            if offset >= len(data):
+                break
+
+        if fec_group_size > 0 and len(fragments) > 1:
+            for start in range(0, len(fragments), fec_group_size):
+                group = fragments[start:start + fec_group_size]
+                group[-1].parity_packet = self.build_parity(self, group, flags_type,
+                                                            identifier, window_size)
+
+        return seq_number, fragments
+
+    # Build the parity packet of a group of fragments, with the sequence number
+    # of the first fragment of the group and the urgent flag of the message
+    @staticmethod
+    def build_parity(self, fragments, flags_type, identifier, window_size):
+        data = memoryview(encode_parity([fragment.data for fragment in fragments],
+                                        [fragment.flags_type for fragment in fragments]))
 
-        data_segments = ([data[i:i + data_chunk_size]
-                         for i in range(0, len(data), data_chunk_size)] or [b""])
-
-        for i, data_segment in enumerate(data_segments):
-
-            # Set the "more_fragments" flag
-            flags["more_fragments"] = 1 if i < len(data_segments) - 1 else 0
-
-            # Rebuild the flags and type field
-            flags_type = (
-                (flags.get("ack",            0) << 7) |
-                (flags.get("retransmission", 0) << 6) |
-                (flags.get("urgent",         0) << 5) |
-                (flags.get("window_probe",   0) << 4) |
-                (flags.get("more_fragments", 0) << 3) |
-                (msg_type & 0b00000111)
-            )
+        flags_type = (flags_type & URGENT_FLAG) | self.PARITY
+        seq_number = fragments[0].seq_number
+        msg_id = fragments[0].msg_id
 
-            # Build the header
-            header = self.build_header(self,
-                                       seq_number,
-                                       flags_type,
-                                       window_size,
-                                       msg_id,
-                                       identifier,
-                                       data_segment)
+        header = bytearray(self.pack_header(self, seq_number, flags_type, window_size,
+                                            msg_id, identifier, data))
 
-            # Build the packet and append it to the list
-            packet = header + data_segment
-            packets.append(packet)
+        return OutboundPacket(header, data, seq_number, msg_id, flags_type)
 
-            # Increment the sequence number for the next fragment
-            seq_number += 1
+    # Build the fragments of a message as contiguous packets,
+    # each parity packet (FEC) following the last fragment of its group
+    @staticmethod
+    def build_packet(self, data, seq_number, flags, msg_type, identifier, window_size,
+                     fec_group_size=0):
+        seq_number, fragments = self.build_fragments(self, data, seq_number, flags,
+                                                     msg_type, identifier, window_size,
+                                                     fec_group_size=fec_group_size)
 
+        packets = []
+        for fragment in fragments:
+            packets.append(bytes(fragment.header) + fragment.data)
+            parity = fragment.parity_packet
+            if parity is not None:
+                packets.append(bytes(parity.header) + parity.data)
         return seq_number, packets
 
-    def build_ack_packet(self, packet, identifier, window_size):
+    # Build the ACK of a packet, with the ACK block (ACK number, SACK bitmap)
+    # of the packets received, if the NetTask version supports it
+    def build_ack_packet(self, packet, identifier, window_size, ack_block=None):
         # Set the appropriate flags for the ACK packet combine the remaining
         # flags and type of the packet being acknowledged
-        flags_type = (
-            (1 << 7) |  # set ACK flag
-            (0 << 6) |  # unset retransmission flag
-            (packet['flags'].get("urgent", 0) << 5) |
-            (0 << 4) |  # unset window probe flag
-            (0 << 3) |  # unset more fragments flag
-            (packet["msg_type"] & 0b00000111)
-        )
+        flags_type = ACK_FLAG | (packet.flags_type & URGENT_FLAG) | packet.msg_type
 
-        ack_number = packet["seq_number"]
+        ack_number = packet.seq_number
+
+        data = b""
+        if ack_block is not None and C.NET_TASK_VERSION in SACK_VERSIONS:
+            data = ACK_BLOCK_STRUCT.pack(*ack_block)
 
         # Build the header
         header = self.build_header(self,
                                    ack_number,
                                    flags_type,
                                    window_size,
-                                   packet["msg_id"],
+                                   packet.msg_id,
                                    identifier,
-                                   "")
+                                   data)
+
+        return header + data
+
+    # Build the NACK of the missing fragments of a message, listing
+    # their sequence numbers (up to MAX_NACK_SEQ_NUMBERS)
+    def build_nack_packet(self, seq_numbers, msg_id, identifier, window_size):
+        seq_numbers = seq_numbers[:MAX_NACK_SEQ_NUMBERS]
+        flags_type = URGENT_FLAG | self.NACK
+
+        data = struct.pack(f"!{len(seq_numbers)}H", *seq_numbers)
+
+        # Build the header, with the first missing sequence number
+        header = self.build_header(self,
+                                   seq_numbers[0],
+                                   flags_type,
+                                   window_size,
+                                   msg_id,
+                                   identifier,
+                                   data)
+
+        return header + data
+
+
+# Rebuild the fragment missing from a parity group, from the parity packet and the
+# other fragments of the group (received packets), as if it was received
+def recover_fragment(parity, fragments, seq_number):
+    flags_type, data = decode_parity(parity.data,
+                                     [fragment.raw[HEADER_SIZE:] for fragment in fragments],
+                                     [fragment.flags_type for fragment in fragments])
+
+    header = bytearray(HEADER_STRUCT.pack(parity.version, seq_number, flags_type,
+                                          parity.window_size, 0, parity.msg_id,
+                                          parity.raw_identifier))
+    checksum = NetTask.calculate_checksum(header, data, parity.version)
+    CHECKSUM_STRUCT.pack_into(header, CHECKSUM_START, checksum)
 
-        return header
+    return NetTask.parse_packet(NetTask, bytes(header + data))
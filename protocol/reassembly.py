@@ -0,0 +1,231 @@
+# Reassembly of the fragmented NetTask messages received from a peer.
+#
+# The fragments of a message have consecutive sequence numbers, starting at the
+# message id, so each fragment has a slot given by its offset to the message id.
+# The number of slots is known once the last fragment (more fragments flag unset)
+# is received, and the message is complete when all the slots are filled.
+# Messages that stop receiving fragments can be evicted after a while.
+# The slots are allocated up to the last fragment received, so they're bounded
+# and charged to the size of the message along with the data of the fragments.
+#
+# With FEC, the parity of each group of fragments is kept in the slot of the first
+# fragment of the group, and a fragment missing from a group is rebuilt as soon as
+# all the other fragments and the parity of the group are received. The fragments
+# that can still be rebuilt aren't reported as missing, until the fragments of the
+# next group or the parity of their group are received.
+
+import constants as C
+
+from .sack     import ACK_BLOCK_SIZE, SEQ_MODULO
+from .fec      import PARITY_HEADER_SIZE, parity_group_size
+from .net_task import HEADER_SIZE, recover_fragment
+
+# Size charged for each slot of a message, a reference in the slots list
+SLOT_SIZE = 8  # bytes
+
+# Size of the data of the fragments of a message but the last one, the smallest
+# with the ACK block and the parity header, and the most fragments of a message
+# that fits in the reassembly budget of an agent
+MIN_FRAGMENT_SIZE = C.BUFFER_SIZE - HEADER_SIZE - ACK_BLOCK_SIZE - PARITY_HEADER_SIZE
+MAX_FRAGMENTS     = C.AGENT_REASSEMBLY_BUDGET // MIN_FRAGMENT_SIZE
+
+
+# Slot of a packet, its offset to the message id
+def slot_of(packet):
+    return (packet.seq_number - packet.msg_id) % SEQ_MODULO
+
+
+# Fragments received of a message
+class Message:
+    __slots__ = ("msg_id", "fragments", "parities", "received", "size", "nr_bytes", "nacked",
+                 "last_time")
+
+    def __init__(self, msg_id):
+        self.msg_id    = msg_id
+        self.fragments = []      # Fragment slots, None while the fragment is missing
+        self.parities  = dict()  # Parity packets, by slot of the first fragment of the group
+        self.received  = 0       # Number of fragments received
+        self.size      = None    # Number of fragments, once the last one is received
+        self.nr_bytes  = 0       # Size of the slots and of the fragments and parities data
+        self.nacked    = set()   # Slots of the missing fragments already reported (NACK)
+        self.last_time = None    # Time the last fragment was received
+
+    # Slot of a packet, its offset to the message id
+    def slot(self, packet):
+        return (packet.seq_number - self.msg_id) % SEQ_MODULO
+
+    # Size of the slots and of the data a packet adds to the message
+    def cost(self, packet):
+        if packet.parity:
+            return len(packet.data)
+        return len(packet.data) + max(0, self.slot(packet) + 1 - len(self.fragments)) * SLOT_SIZE
+
+    # Add a fragment to its slot, return False if it was already received
+    def add(self, packet, now):
+        index = self.slot(packet)
+        if index >= len(self.fragments):
+            slots = index + 1 - len(self.fragments)
+            self.fragments.extend([None] * slots)
+            self.nr_bytes += slots * SLOT_SIZE
+        elif self.fragments[index] is not None:
+            return False
+
+        self.fragments[index] = packet
+        self.received += 1
+        self.nr_bytes += len(packet.data)
+        self.last_time = now
+        if packet.more_fragments == 0:
+            self.size = index + 1
+        return True
+
+    # Add the parity of a group, return False if it was already received
+    def add_parity(self, packet, now):
+        index = self.slot(packet)
+        if index in self.parities:
+            return False
+
+        self.parities[index] = packet
+        self.nr_bytes += len(packet.data)
+        self.last_time = now
+        return True
+
+    # Slot of the first fragment of the parity group of a slot, None if the parity
+    # of its group wasn't received
+    def group_of(self, index):
+        for start, parity in self.parities.items():
+            if start <= index < start + parity_group_size(parity.data):
+                return start
+        return None
+
+    # Rebuild the fragment missing from a parity group, if it's the only one missing,
+    # return the fragment rebuilt or None
+    def recover(self, start):
+        parity = self.parities.get(start)
+        if parity is None:
+            return None
+
+        group = range(start, start + parity_group_size(parity.data))
+        missing = [index for index in group
+                   if index >= len(self.fragments) or self.fragments[index] is None]
+        if len(missing) != 1:
+            return None
+
+        fragments = [self.fragments[index] for index in group if index != missing[0]]
+        return recover_fragment(parity, fragments, (self.msg_id + missing[0]) % SEQ_MODULO)
+
+    def is_complete(self):
+        return self.received == self.size
+
+    # Join the data of the fragments, the packet of the first
+    # fragment is returned as is if the message isn't fragmented
+    def join(self):
+        if self.size == 1:
+            return self.fragments[0]
+        return self.fragments[0].with_data(b"".join([p.data for p in self.fragments]))
+
+    # Check if a missing fragment can still be rebuilt, with FEC groups of a size,
+    # as neither the parity of its group nor the fragments after it were received
+    def is_recoverable(self, index, fec_group_size):
+        if fec_group_size <= 0:
+            return False
+        start = index - index % fec_group_size
+        return start not in self.parities and len(self.fragments) <= start + fec_group_size
+
+    # Get the sequence numbers of the fragments missing before the last
+    # fragment received, that weren't reported yet, marking them as reported
+    def missing(self, limit, fec_group_size=0):
+        missing = [index for index, packet in enumerate(self.fragments)
+                   if packet is None and index not in self.nacked
+                   and not self.is_recoverable(index, fec_group_size)][:limit]
+        self.nacked.update(missing)
+        return [(self.msg_id + index) % SEQ_MODULO for index in missing]
+
+    def __repr__(self):
+        return f"Message(msg_id={self.msg_id}, received={self.received}, size={self.size})"
+
+
+# Messages being reassembled, by message id
+class ReassemblyBuffer:
+    __slots__ = ("messages", "nr_fragments", "nr_bytes")
+
+    def __init__(self):
+        self.messages     = dict()
+        self.nr_fragments = 0  # Number of fragments buffered, of all the messages
+        self.nr_bytes     = 0  # Size of the slots and data buffered, of all the messages
+
+    # Size a packet adds to the buffer, None if it can't be buffered, as its slot is
+    # over the fragments of a message, or it starts a message over the partial messages
+    def cost(self, packet, max_messages=None):
+        if slot_of(packet) >= MAX_FRAGMENTS:
+            return None
+
+        message = self.messages.get(packet.msg_id)
+        if message is None:
+            if max_messages is not None and len(self.messages) >= max_messages:
+                return None
+            message = Message(packet.msg_id)
+        return message.cost(packet)
+
+    # Add a fragment or a parity packet, return the reassembled packet once the
+    # message is complete, or None while fragments are missing, and the fragments
+    # rebuilt from the parity of their group. The packets with a slot over the
+    # fragments of a message are discarded
+    def add(self, packet, now=None):
+        if slot_of(packet) >= MAX_FRAGMENTS:
+            return None, []
+
+        message = self.messages.get(packet.msg_id)
+        if message is None:
+            message = self.messages[packet.msg_id] = Message(packet.msg_id)
+
+        nr_bytes = message.nr_bytes
+        if packet.parity:
+            message.add_parity(packet, now)
+            start = message.slot(packet)
+        else:
+            if message.add(packet, now):
+                self.nr_fragments += 1
+            start = message.group_of(message.slot(packet))
+
+        recovered = []
+        if start is not None:
+            fragment = message.recover(start)
+            if fragment is not None and message.add(fragment, now):
+                self.nr_fragments += 1
+                recovered.append(fragment)
+
+        self.nr_bytes += message.nr_bytes - nr_bytes
+
+        if not message.is_complete():
+            return None, recovered
+
+        self.remove(message)
+        return message.join(), recovered
+
+    def remove(self, message):
+        del self.messages[message.msg_id]
+        self.nr_fragments -= message.received
+        self.nr_bytes -= message.nr_bytes
+
+    # Evict the messages without fragments received since a given time,
+    # return the messages evicted
+    def evict(self, older_than):
+        evicted = [message for message in self.messages.values()
+                   if message.last_time < older_than]
+        for message in evicted:
+            self.remove(message)
+        return evicted
+
+    # Get the sequence numbers of the missing fragments of a message, not reported yet
+    # nor recoverable with FEC groups of a size
+    def missing(self, msg_id, limit, fec_group_size=0):
+        message = self.messages.get(msg_id)
+        if message is None:
+            return []
+        return message.missing(limit, fec_group_size)
+
+    def __len__(self):
+        return self.nr_fragments
+
+    def __repr__(self):
+        return f"ReassemblyBuffer({list(self.messages.values())})"
@@ -0,0 +1,45 @@
+# Round-trip time estimation and retransmission timeout (RTO) calculation
+# for NetTask peers, based on RFC 6298.
+
+import constants as C
+
+# Gains of the smoothed RTT and RTT variation
+ALPHA = 1 / 8
+BETA  = 1 / 4
+
+# Multiplier of the RTT variation in the RTO
+K = 4
+
+# Clock granularity
+CLOCK_GRANULARITY = 0.001  # seconds
+
+
+class RTTEstimator:
+    __slots__ = ("srtt", "rttvar", "rto", "backoffs")
+
+    def __init__(self):
+        self.srtt     = None  # Smoothed round-trip time
+        self.rttvar   = None  # Round-trip time variation
+        self.rto      = C.INITIAL_RTO
+        self.backoffs = 0     # Consecutive timeouts without a new sample
+
+    # Update the estimates with a new RTT sample, measured from a packet
+    # that wasn't retransmitted (Karn's algorithm)
+    def add_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt   = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt   = (1 - ALPHA) * self.srtt + ALPHA * rtt
+
+        self.rto = self.srtt + max(CLOCK_GRANULARITY, K * self.rttvar)
+        self.rto = min(max(self.rto, C.MIN_RTO), C.MAX_RTO)
+        self.backoffs = 0
+
+    # Exponential backoff of the RTO after a retransmission timeout.
+    # The RTO is doubled from the timeout that expired, so packets that
+    # were sent with the same RTO and expire together only double it once.
+    def backoff(self, expired_rto):
+        self.rto = max(self.rto, min(expired_rto * 2, C.MAX_RTO))
+        self.backoffs += 1
@@ -0,0 +1,113 @@
+# Cumulative and selective acknowledgments (SACK) of NetTask.
+#
+# ACK block, at the start of the data of ACK packets:
+# - ACK number  (2 bytes) next sequence number expected, all the packets
+#                         with a lower sequence number were received
+# - SACK bitmap (4 bytes) bit i is set if the packet with the sequence number
+#                         ACK number + 1 + i was received (out of order)
+#
+# Sequence numbers are 16-bit and are compared with modular arithmetic.
+
+import struct
+import constants as C
+
+# Struct format for the ACK block
+# !    network (big-endian) byte order
+# H    unsigned short      (2 bytes)
+# I    unsigned int        (4 bytes)
+ACK_BLOCK_STRUCT = struct.Struct('!H I')
+ACK_BLOCK_SIZE   = ACK_BLOCK_STRUCT.size
+
+# Number of sequence numbers after the ACK number covered by the SACK bitmap
+SACK_BITS = 32
+SACK_MASK = (1 << SACK_BITS) - 1
+
+# Sequence numbers range
+SEQ_MODULO = 1 << 16
+
+
+# Signed distance from the sequence number b to a, modulo 2^16
+def seq_diff(a, b):
+    diff = (a - b) % SEQ_MODULO
+    return diff - SEQ_MODULO if diff >= SEQ_MODULO // 2 else diff
+
+
+# Check if a sequence number is acknowledged by an ACK block
+def is_acknowledged(seq_number, ack_number, sack_bitmap):
+    diff = seq_diff(seq_number, ack_number)
+    if diff < 0:
+        return True
+    return 0 < diff <= SACK_BITS and (sack_bitmap >> (diff - 1)) & 1 == 1
+
+
+# Remove the packets acknowledged by an ACK block from the packets to be acknowledged,
+# a dict by sequence number in the order they were sent, return the packets removed.
+# Only the packets acknowledged are visited: the oldest ones, until the first not
+# acknowledged in order, and the ones set in the SACK bitmap.
+def pop_acknowledged(packets, ack_number, sack_bitmap):
+    in_order = []
+    for seq_number in packets:
+        if seq_diff(seq_number, ack_number) >= 0:
+            break
+        in_order.append(seq_number)
+    acknowledged = [packets.pop(seq_number) for seq_number in in_order]
+
+    while sack_bitmap:
+        bit = sack_bitmap & -sack_bitmap
+        sack_bitmap ^= bit
+        packet = packets.pop((ack_number + bit.bit_length()) % SEQ_MODULO, None)
+        if packet is not None:
+            acknowledged.append(packet)
+
+    return acknowledged
+
+
+# Sequence numbers received from a peer, to discard the duplicated packets and to
+# build its ACK blocks. The packets received are tracked by a bitmap anchored at
+# the ACK number: all the packets before it were received, bit i is set if the
+# packet ACK number + 1 + i was received. The bitmap is bounded by the window size,
+# the packets further ahead aren't tracked and must be discarded without an ACK.
+class ReceiveState:
+    __slots__ = ("ack_number", "bitmap")
+
+    def __init__(self, ack_number):
+        self.ack_number = ack_number  # Next sequence number expected
+        self.bitmap     = 0           # Packets received after a gap
+
+    # Check if a sequence number isn't ahead of the window
+    def in_window(self, seq_number):
+        return seq_diff(seq_number, self.ack_number) <= C.DUPLICATE_WINDOW_SIZE
+
+    # Add a received sequence number, advancing the ACK number over the packets
+    # received out of order that are now in order. Return False if the packet
+    # was already received (or is ahead of the window)
+    def add(self, seq_number):
+        diff = seq_diff(seq_number, self.ack_number)
+        if diff < 0 or diff > C.DUPLICATE_WINDOW_SIZE:
+            return False
+
+        if diff > 0:
+            bit = 1 << (diff - 1)
+            if self.bitmap & bit:
+                return False
+            self.bitmap |= bit
+            return True
+
+        # count the packets received in order after this one (trailing ones)
+        in_order = (~self.bitmap & (self.bitmap + 1)).bit_length() - 1
+        self.ack_number = (self.ack_number + 1 + in_order) % SEQ_MODULO
+        self.bitmap >>= 1 + in_order
+        return True
+
+    # Check if a sequence number was received
+    def is_received(self, seq_number):
+        diff = seq_diff(seq_number, self.ack_number)
+        return diff < 0 or (diff > 0 and (self.bitmap >> (diff - 1)) & 1 == 1)
+
+    # Check if all the packets received are in order (no gaps)
+    def is_in_order(self):
+        return self.bitmap == 0
+
+    # Build the ACK number and SACK bitmap
+    def ack_block(self):
+        return self.ack_number, self.bitmap & SACK_MASK
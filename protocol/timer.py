@@ -0,0 +1,128 @@
+# Timer service for the NetTask endpoints.
+# A single thread keeps the timers in a heap ordered by deadline, and sleeps
+# until the earliest one is due, so there is no work while no timers are due.
+# Retransmissions, window probes and end of connection timeouts are scheduled
+# as timers instead of being polled by sleeping threads.
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline  = deadline
+        self.callback  = callback
+        self.args      = args
+        self.cancelled = False
+
+    # Cancelled timers are discarded when they reach the top of the heap
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerService(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.timers = []
+        self.counter = itertools.count()  # Tie breaker for timers with the same deadline
+        self.condition = threading.Condition()
+        self.shutdown_flag = threading.Event()
+
+    # Schedule the callback to be called with the args after the delay (in seconds)
+    def schedule(self, delay, callback, *args):
+        timer = Timer(time.monotonic() + delay, callback, args)
+
+        with self.condition:
+            heapq.heappush(self.timers, (timer.deadline, next(self.counter), timer))
+
+            # Wake up the timer thread if the new timer is the earliest
+            if self.timers[0][2] is timer:
+                self.condition.notify()
+
+        return timer
+
+    # Number of scheduled timers, including cancelled timers not yet discarded
+    def __len__(self):
+        with self.condition:
+            return len(self.timers)
+
+    def run(self):
+        while not self.shutdown_flag.is_set():
+            timer = self.next_timer()
+            if timer is None:
+                break
+
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f"Error running timer {timer.callback.__name__}: {e}")
+
+    # Wait until a timer is due and remove it from the heap,
+    # returns None when the service is shutdown
+    def next_timer(self):
+        with self.condition:
+            while not self.shutdown_flag.is_set():
+                if not self.timers:
+                    self.condition.wait()
+                    continue
+
+                deadline, _, timer = self.timers[0]
+                if timer.cancelled:
+                    heapq.heappop(self.timers)
+                    continue
+
+                delay = deadline - time.monotonic()
+                if delay <= 0:
+                    heapq.heappop(self.timers)
+                    return timer
+
+                self.condition.wait(delay)
+
+        return None
+
+    def shutdown(self):
+        with self.condition:
+            self.shutdown_flag.set()
+            self.condition.notify()
+
+
+# Timer service on an asyncio event loop, with the same interface as the timer
+# service thread, for the endpoints running on the loop. Timers can be scheduled
+# from any thread, the callbacks are called by the loop.
+class LoopTimers:
+    def __init__(self, loop):
+        self.loop = loop
+
+    def schedule(self, delay, callback, *args):
+        timer = Timer(time.monotonic() + delay, callback, args)
+
+        if self.in_loop():
+            self.loop.call_later(delay, self.run, timer)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.run, timer)
+
+        return timer
+
+    def in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def run(self, timer):
+        if timer.cancelled:
+            return
+
+        try:
+            timer.callback(*timer.args)
+        except Exception as e:
+            print(f"Error running timer {timer.callback.__name__}: {e}")
+
+    # The timers are dropped with the loop
+    def shutdown(self):
+        pass
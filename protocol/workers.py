@@ -0,0 +1,77 @@
+# Worker pool for the NetTask endpoints.
+# A fixed number of threads handle the datagrams received, instead of a thread
+# started for each datagram. Each worker has its own bounded queue (lane), and
+# the datagrams are dispatched to a lane by the identifier of the peer, so the
+# packets of a peer are handled one at a time and in the order received, while
+# the packets of different peers are handled in parallel by different lanes.
+# When a lane is full the datagram is dropped, as the socket would, and the peer
+# retransmits it later. The depth of the lane of a peer is the backlog of datagrams
+# not handled yet, which is taken from the window size advertised to that peer.
+
+import queue
+import threading
+
+
+class WorkerPool:
+    def __init__(self, nr_workers, queue_size, name="worker"):
+        lane_size = max(1, -(-queue_size // nr_workers))
+        self.lanes = [queue.Queue(maxsize=lane_size) for _ in range(nr_workers)]
+        self.dropped = 0  # Number of jobs dropped with the lane full
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.run, args=(lane,),
+                                         name=f"{name}-{i}", daemon=True)
+                        for i, lane in enumerate(self.lanes)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    # Lane of the jobs of a key, the same key is always dispatched to the same lane
+    def get_lane(self, key):
+        return self.lanes[hash(key) % len(self.lanes)]
+
+    # Queue the callback to be called with the args by the worker of the key lane,
+    # after the jobs queued before with the same key, return False if the lane is
+    # full and the job was dropped
+    def submit(self, key, callback, *args):
+        try:
+            self.get_lane(key).put_nowait((callback, args))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        return True
+
+    # Number of jobs queued in the lane of a key, not yet taken by a worker
+    def get_depth(self, key):
+        return self.get_lane(key).qsize()
+
+    # Number of jobs queued in all the lanes, not yet taken by a worker
+    def __len__(self):
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def get_dropped(self):
+        with self.lock:
+            return self.dropped
+
+    def run(self, lane):
+        while True:
+            job = lane.get()
+            if job is None:
+                break
+
+            callback, args = job
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Error running worker job {callback.__name__}: {e}")
+
+    # Stop the workers once the jobs queued are done
+    def shutdown(self):
+        for lane in self.lanes:
+            lane.put(None)
+
+    def join(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join()
@@ -2,7 +2,8 @@
 # Checksum test
 # Two packets are builded with different sequence numbers,
 # then the checksums are compared,
-# the test fails if the checksums are the same
+# the test fails if the checksums are the same,
+# or if the data of the packets parsed isn't the data sent
 
 import sys
 import os
@@ -19,9 +20,10 @@ def main():
     print("Packets as binary data\n")
 
     # Build the packets with different sequence numbers
-    _, packet1 = NetTask.build_packet(NetTask, "Example data", 1, {"ack": 1},
+    data = "Example data"
+    _, packet1 = NetTask.build_packet(NetTask, data, 1, {"ack": 1},
                                       NetTask.UNDEFINED, "agent47", 32)
-    _, packet2 = NetTask.build_packet(NetTask, "Example data", 0, {"ack": 1},
+    _, packet2 = NetTask.build_packet(NetTask, data, 0, {"ack": 1},
                                       NetTask.UNDEFINED, "agent47", 32)
 
     packet1 = packet1[0]
@@ -34,13 +36,13 @@ def main():
     packet1 = NetTask.parse_packet(NetTask, packet1)
     packet2 = NetTask.parse_packet(NetTask, packet2)
 
-    checksum1 = packet1["checksum"]
-    checksum2 = packet2["checksum"]
+    checksum1 = packet1.checksum
+    checksum2 = packet2.checksum
 
     print("\nParsed packets as JSON\n")
 
-    print(f"Packet 1: {json.dumps(packet1, indent=2)}")
-    print(f"Packet 2: {json.dumps(packet2, indent=2)}")
+    print(f"Packet 1: {json.dumps(packet1.to_dict(), indent=2)}")
+    print(f"Packet 2: {json.dumps(packet2.to_dict(), indent=2)}")
 
     print("\nChecksums\n")
 
@@ -49,10 +51,17 @@ def main():
 
     print()
 
+    # The data must be parsed as sent, without an ACK block taken from it
+    for packet in (packet1, packet2):
+        if packet.text != data or packet.ack_block is not None:
+            print(f"Failure data parsed {packet.text!r}, ACK block {packet.ack_block}")
+            sys.exit(1)
+
     if checksum1 != checksum2:
         print("Success checksums are different")
     else:
         print("Failure checksums are the same")
+        sys.exit(1)
 
 
 if __name__ == '__main__':
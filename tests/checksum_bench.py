@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Checksum microbenchmark
+# Compares the previous byte-by-byte NetTask checksum with the bulk
+# 16-bit sum and the CRC32 mode, for payloads of 64, 512 and 1500 bytes,
+# the test fails if the bulk sum doesn't match the previous checksum
+
+import sys
+import os
+import timeit
+
+# Join the parent directory to the sys path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol.net_task import NetTask
+from protocol.net_task import CHECKSUM_START, CHECKSUM_END
+
+# Payload sizes to benchmark, in bytes
+PAYLOAD_SIZES = [64, 512, 1500]
+
+# Number of checksums calculated for each measure
+ITERATIONS = 2000
+
+
+# Previous implementation of the checksum, used as reference
+def legacy_checksum(packet):
+    data = packet[:CHECKSUM_START] + packet[CHECKSUM_END:]
+
+    checksum = 0
+    for i in range(0, len(data), 2):
+        part = data[i:i + 2]
+        if len(part) == 1:
+            part += b'\x00'
+        checksum += int.from_bytes(part, 'big')
+
+    while checksum > 0xFFFF:
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)
+
+    return ~checksum & 0xFFFF
+
+
+def measure(function):
+    return min(timeit.repeat(function, number=ITERATIONS, repeat=5)) / ITERATIONS
+
+
+def main():
+    success = True
+
+    print(f"{'Payload':>8} {'Legacy':>12} {'Sum16':>12} {'CRC32':>12} {'Speedup':>8}")
+
+    for size in PAYLOAD_SIZES:
+        # Build a packet with a header and a payload of the given size
+        data = os.urandom(size)
+        header = NetTask.build_header(NetTask, 1, NetTask.UNDEFINED, 32, 1, "agent47", data)
+        packet = header + data
+
+        if legacy_checksum(packet) != NetTask.calculate_checksum(header, data, version=1):
+            print(f"Failure checksums differ for a payload of {size} bytes")
+            success = False
+
+        legacy = measure(lambda: legacy_checksum(packet))
+        sum16  = measure(lambda: NetTask.calculate_checksum(header, data, version=1))
+        crc32  = measure(lambda: NetTask.calculate_checksum(header, data, version=2))
+
+        print(f"{size:>6} B {legacy * 1e6:>9.2f} us {sum16 * 1e6:>9.2f} us "
+              f"{crc32 * 1e6:>9.2f} us {legacy / sum16:>7.1f}x")
+
+    print()
+
+    if success:
+        print("Success checksums match the previous implementation")
+    else:
+        print("Failure checksums don't match the previous implementation")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Forward error correction (FEC) test
+# The fragments of a message are built with a parity packet per group of fragments,
+# then each fragment of each group is dropped in turn and rebuilt from the parity
+# packet and the other fragments of the group, the test fails if a fragment
+# rebuilt isn't the same packet (header and data) as the one dropped
+
+import sys
+import os
+
+# Join the parent directory to the sys path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol.net_task import NetTask, HEADER_SIZE, recover_fragment
+from protocol.fec import PARITY_HEADER_SIZE
+import constants as C
+
+failures = []
+
+
+# Split the packets of a message in parity groups, the fragments of each
+# group and its parity packet, which is sent after them
+def parity_groups(packets):
+    groups = []
+    fragments = []
+    for packet in packets:
+        packet = NetTask.parse_packet(NetTask, packet)
+        if packet.parity:
+            groups.append((fragments, packet))
+            fragments = []
+        else:
+            fragments.append(packet)
+
+    if fragments:
+        failures.append(f"{len(fragments)} fragments without a parity packet")
+    return groups
+
+
+# Drop each fragment of each group in turn and rebuild it
+def check_recovery(name, packets, group_size):
+    groups = parity_groups(packets)
+    fragments = sum(len(group) for group, _ in groups)
+    print(f"{name}: {fragments} fragments, {len(groups)} parity groups")
+
+    for group, parity in groups:
+        if parity.parity_seq_numbers != [fragment.seq_number for fragment in group]:
+            failures.append(f"{name}: parity of {parity.parity_seq_numbers}, "
+                            f"group of {[fragment.seq_number for fragment in group]}")
+        if len(group) > group_size:
+            failures.append(f"{name}: group of {len(group)} fragments")
+
+        for dropped in group:
+            others = [fragment for fragment in group if fragment is not dropped]
+            recovered = recover_fragment(parity, others, dropped.seq_number)
+
+            if bytes(recovered.raw) != bytes(dropped.raw):
+                failures.append(f"{name}: fragment {dropped.seq_number} rebuilt with "
+                                f"a different header or data")
+            elif bytes(recovered.data) != bytes(dropped.data):
+                failures.append(f"{name}: fragment {dropped.seq_number} data parsed "
+                                f"differently")
+
+
+def main():
+    fragment_size = C.BUFFER_SIZE - HEADER_SIZE - PARITY_HEADER_SIZE
+
+    # Data of 7 fragments and a half, different in each fragment, the last group
+    # isn't full and its last fragment is shorter than the others
+    data = bytes(index % 251 for index in range(fragment_size * 7 + fragment_size // 2))
+
+    # Sequence numbers wrapping around 65535 within the groups
+    _, packets = NetTask.build_packet(NetTask, data, 65533, {},
+                                      NetTask.SEND_METRICS, "agent47", 32,
+                                      fec_group_size=3)
+    check_recovery("Message", packets, 3)
+
+    # The ACK block piggybacked on the first fragment, with the ACK flag set on it only
+    _, fragments = NetTask.build_fragments(NetTask, data, 10, {"urgent": 1},
+                                           NetTask.SEND_METRICS, "agent47", 32,
+                                           ack_block=(7, 0b101), fec_group_size=4)
+    packets = []
+    for fragment in fragments:
+        packets.append(bytes(fragment.header) + fragment.data)
+        if fragment.parity_packet is not None:
+            packets.append(bytes(fragment.parity_packet.header) + fragment.parity_packet.data)
+    check_recovery("Message with an ACK block", packets, 4)
+
+    print()
+
+    if failures:
+        for failure in failures:
+            print(f"Failure {failure}")
+        sys.exit(1)
+
+    print("Success all the fragments dropped were rebuilt from the parity packets")
+
+
+if __name__ == '__main__':
+    main()
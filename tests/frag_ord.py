@@ -39,8 +39,9 @@ def main():
 
     agent_id = "test_agent"
 
-    # Sequence number as 0 so the server will not discard the packet as a duplicate
-    seq_nr, packets = NetTask.build_packet(NetTask, data, 10000, {},
+    # The sequence numbers follow the first connection (sequence number 0), so the
+    # packets are within the window of sequence numbers tracked by the server
+    seq_nr, packets = NetTask.build_packet(NetTask, data, 1, {},
                                            NetTask.UNDEFINED, agent_id, 32)
 
     # Reverse the order of the packets
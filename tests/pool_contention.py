@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Server pool contention benchmark
+# Each agent is simulated by a thread that handles its packets as the server does:
+# checksum and parsing, window and duplicate checks, an ACK with its ACK block sent
+# through a UDP socket, reassembly and decoding of the metrics, and the packets sent
+# added to be acknowledged and acknowledged, for an increasing number of agents.
+# The pool, with a lock per agent session, is compared with the same pool with every
+# call serialized on a single lock, as the previous pool with one global lock, by the
+# packets handled per second and the 99th percentile of the time to handle a packet.
+# Under the GIL the work of the pool isn't run in parallel, the threads only overlap
+# on the socket calls, so both pools are expected to handle about the same packets
+# per second, the comparison is reported and not checked.
+# The test fails if any message isn't reassembled or any packet is left to be acknowledged
+
+import sys
+import os
+import time
+import threading
+import socket
+import statistics
+import json
+
+# Join the parent directory to the sys path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nms_server.pool import Pool
+from protocol.net_task import NetTask
+
+# Number of agents (threads) to benchmark
+AGENT_COUNTS = [1, 2, 4, 8, 16]
+
+# Number of runs of each benchmark, the median is reported
+RUNS = 3
+
+# Number of messages handled by each agent, with 3 fragments each
+MESSAGES_PER_AGENT = 200
+MESSAGE = json.dumps({"task_id": "task1",
+                      "metrics": [{"cpu_usage": i, "ram_usage": i * 2, "interface_stats": i * 3}
+                                  for i in range(80)]})
+
+# Pool methods called by the benchmark
+POOL_METHODS = ["add_client", "is_packet_in_window", "has_buffer_space", "add_packet_received",
+                "get_ack_block", "get_server_window_size", "reorder_packets",
+                "add_packet_to_ack", "remove_packet_to_ack"]
+
+
+# Pool with every call serialized on a single lock
+class GlobalLockPool(Pool):
+    def __init__(self):
+        super().__init__()
+        self.global_lock = threading.Lock()
+
+
+def serialized(method):
+    def wrapper(self, *args):
+        with self.global_lock:
+            return method(self, *args)
+    return wrapper
+
+
+for name in POOL_METHODS:
+    setattr(GlobalLockPool, name, serialized(getattr(Pool, name)))
+
+
+# Build the packets sent by an agent, the agent work isn't measured
+def build_agent_packets(agent_id):
+    seq_number = 1
+    messages = []
+    for _ in range(MESSAGES_PER_AGENT):
+        seq_number, fragments = NetTask.build_fragments(NetTask, MESSAGE, seq_number, {},
+                                                        NetTask.SEND_METRICS, agent_id, 32)
+        messages.append(fragments)
+    return messages
+
+
+# Handle the packets of an agent: the fragments received are checked, acknowledged
+# and reassembled in the pool, and the fragments sent are added to be acknowledged
+# and then acknowledged by the ACK block of the agent
+def run_agent(pool, agent_id, messages, addr, results, latencies):
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    reassembled = 0
+    times = []
+    for fragments in messages:
+        for fragment in fragments:
+            start = time.perf_counter()
+
+            packet = NetTask.parse_packet(NetTask, bytes(fragment.header) + fragment.data)
+            if not pool.is_packet_in_window(agent_id, packet.seq_number):
+                continue
+            if not pool.has_buffer_space(agent_id, packet):
+                continue
+            if not pool.add_packet_received(agent_id, packet.seq_number):
+                continue
+
+            ack_packet = NetTask.build_ack_packet(NetTask, packet, agent_id,
+                                                  pool.get_server_window_size(agent_id),
+                                                  pool.get_ack_block(agent_id))
+            udp_socket.sendto(ack_packet, addr)
+
+            message, _ = pool.reorder_packets(agent_id, packet)
+            if message is not None:
+                json.loads(message.text)
+                reassembled += 1
+
+            fragment.set_timer(time.monotonic(), 1, None)
+            pool.add_packet_to_ack(agent_id, fragment)
+            pool.remove_packet_to_ack(agent_id, None, (packet.seq_number + 1, 0))
+
+            times.append(time.perf_counter() - start)
+
+    udp_socket.close()
+    results[agent_id] = reassembled
+    latencies.extend(times)
+
+
+def measure(pool_class, nr_agents, addr):
+    pool = pool_class()
+    packets = dict()
+    for i in range(nr_agents):
+        agent_id = f"agent{i}"
+        pool.add_client(agent_id, ("127.0.0.1", 0), 1)
+        packets[agent_id] = build_agent_packets(agent_id)
+
+    results = dict()
+    latencies = []
+    threads = [threading.Thread(target=run_agent,
+                                args=(pool, agent_id, messages, addr, results, latencies))
+               for agent_id, messages in packets.items()]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    success = (len(results) == nr_agents
+               and all(reassembled == MESSAGES_PER_AGENT for reassembled in results.values())
+               and pool.get_nr_packets_to_ack() == 0)
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    return len(latencies) / elapsed, p99, success
+
+
+# Median of the runs of a benchmark, by throughput and by latency
+def measure_runs(pool_class, nr_agents, addr):
+    runs = [measure(pool_class, nr_agents, addr) for _ in range(RUNS)]
+    success = all(run_success for _, _, run_success in runs)
+    return (statistics.median(throughput for throughput, _, _ in runs),
+            statistics.median(p99 for _, p99, _ in runs),
+            success)
+
+
+# Receive and discard the ACKs sent by the benchmark
+def drain(udp_socket):
+    try:
+        while True:
+            udp_socket.recv(2048)
+    except OSError:
+        pass
+
+
+def main():
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    threading.Thread(target=drain, args=(sink,), daemon=True).start()
+    addr = sink.getsockname()
+
+    success = True
+
+    print(f"{'Agents':>6} {'Global lock':>14} {'Session locks':>14} {'Speedup':>8} "
+          f"{'p99 global':>11} {'p99 session':>12}")
+
+    for nr_agents in AGENT_COUNTS:
+        global_lock, global_p99, global_success = measure_runs(GlobalLockPool, nr_agents, addr)
+        session_locks, session_p99, session_success = measure_runs(Pool, nr_agents, addr)
+        success = success and global_success and session_success
+
+        print(f"{nr_agents:>6} {global_lock:>10.0f} p/s {session_locks:>10.0f} p/s "
+              f"{session_locks / global_lock:>7.2f}x "
+              f"{global_p99 * 1000:>8.2f} ms {session_p99 * 1000:>9.2f} ms")
+
+    sink.close()
+    print()
+
+    if success:
+        print("Success all the messages were reassembled and acknowledged")
+    else:
+        print("Failure messages not reassembled or packets not acknowledged")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
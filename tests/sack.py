@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Selective acknowledgments (SACK) test
+# The sequence numbers received are tracked by the receive state, near the
+# wraparound of the 16-bit sequence numbers (65535 -> 0), the ACK blocks built
+# are compared with the expected ACK numbers and SACK bitmaps, then the packets
+# acknowledged by an ACK block are removed from the packets to be acknowledged,
+# the test fails if any result isn't the expected one
+
+import sys
+import os
+
+# Join the parent directory to the sys path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol.sack import ReceiveState, pop_acknowledged, SEQ_MODULO
+import constants as C
+
+failures = []
+
+
+# Compare a result with the expected one, saving the failure
+def check(name, result, expected):
+    if result != expected:
+        failures.append(f"{name}: {result}, expected {expected}")
+
+
+def test_receive_state():
+    state = ReceiveState(65533)
+
+    # In order, the ACK number advances
+    check("add 65533", state.add(65533), True)
+    check("ACK block after 65533", state.ack_block(), (65534, 0))
+
+    # Out of order, after the wraparound, 0 and 1 are the bits 1 and 2
+    check("add 0", state.add(0), True)
+    check("add 1", state.add(1), True)
+    check("ACK block after 0, 1", state.ack_block(), (65534, 0b110))
+    check("in order after 0, 1", state.is_in_order(), False)
+
+    # Duplicates, ahead of the ACK number and behind it
+    check("add 0 again", state.add(0), False)
+    check("add 65533 again", state.add(65533), False)
+
+    check("received 65530", state.is_received(65530), True)
+    check("received 65534", state.is_received(65534), False)
+    check("received 65535", state.is_received(65535), False)
+    check("received 0", state.is_received(0), True)
+    check("received 2", state.is_received(2), False)
+
+    # Fill the gap, the ACK number skips the packets received out of order
+    check("add 65534", state.add(65534), True)
+    check("ACK block after 65534", state.ack_block(), (65535, 0b11))
+    check("add 65535", state.add(65535), True)
+    check("ACK block after 65535", state.ack_block(), (2, 0))
+    check("in order after 65535", state.is_in_order(), True)
+    check("add 1 again", state.add(1), False)
+
+    # The packets ahead of the window aren't tracked
+    edge = (2 + C.DUPLICATE_WINDOW_SIZE) % SEQ_MODULO
+    check("in window edge", state.in_window(edge), True)
+    check("in window edge + 1", state.in_window((edge + 1) % SEQ_MODULO), False)
+    check("add edge + 1", state.add((edge + 1) % SEQ_MODULO), False)
+    check("ACK block after edge + 1", state.ack_block(), (2, 0))
+
+
+def test_pop_acknowledged():
+    # Packets to be acknowledged, in the order they were sent
+    packets = {seq_number: f"packet {seq_number}" for seq_number in (65534, 65535, 0, 1, 2, 3)}
+
+    # 65534 and 65535 acknowledged in order, 2 and 3 by the SACK bitmap,
+    # the bit of 5 is for a packet not sent, and is ignored
+    acknowledged = pop_acknowledged(packets, 0, 0b10110)
+    check("acknowledged", acknowledged,
+          ["packet 65534", "packet 65535", "packet 2", "packet 3"])
+    check("left to be acknowledged", list(packets), [0, 1])
+
+    # An ACK block with nothing new acknowledged
+    check("acknowledged again", pop_acknowledged(packets, 0, 0), [])
+    check("left after the same ACK", list(packets), [0, 1])
+
+
+def test_round_trip():
+    # The packets 65530 to 5 are sent, and every third one is lost
+    sent = [(65530 + i) % SEQ_MODULO for i in range(12)]
+    lost = sent[1::3]
+
+    state = ReceiveState(65530)
+    for seq_number in sent:
+        if seq_number not in lost:
+            state.add(seq_number)
+
+    # The sender removes the packets acknowledged by the ACK block of the receiver
+    packets = {seq_number: seq_number for seq_number in sent}
+    ack_number, sack_bitmap = state.ack_block()
+    acknowledged = pop_acknowledged(packets, ack_number, sack_bitmap)
+
+    check("round trip ACK number", ack_number, lost[0])
+    check("round trip acknowledged",
+          sorted(acknowledged, key=sent.index), [s for s in sent if s not in lost])
+    check("round trip left", list(packets), lost)
+
+
+def main():
+    test_receive_state()
+    test_pop_acknowledged()
+    test_round_trip()
+
+    if failures:
+        for failure in failures:
+            print(f"Failure {failure}")
+        sys.exit(1)
+
+    print("Success the ACK blocks and the packets acknowledged are the expected ones")
+
+
+if __name__ == '__main__':
+    main()